@@ -19,6 +19,12 @@ MANAGERS = ADMINS
 CACHE_BACKEND = "locmem:///"
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# Canal de versiones compartido entre procesos ('cache', 'file' o la ruta
+# a una clase). Con CACHE_BACKEND = locmem la cache no se comparte entre
+# procesos, asi que se usa un directorio local.
+VERSION_BACKEND = 'file'
+VERSION_DIR = os.path.join(current, 'run', 'versions').replace('\\', '/')
+
 DATABASE_ENGINE = 'mysql'             # 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
 DATABASE_NAME = 'Example'             # Or path to database file if using sqlite3.
 DATABASE_USER = 'ui'             # Not used with sqlite3.
@@ -104,3 +110,60 @@ INSTALLED_APPS = (
 # Settings para markitup
 MARKITUP_SET = 'markitup/sets/markdown'
 MARKITUP_SKIN = 'markitup/skins/markitup'
+
+# Construir todos los modelos dinamicos de una vez, tras arrancar o tras
+# invalidar la cache completa, en lugar de hacerlo bajo demanda.
+MODEL_CACHE_WARMUP = True
+
+# Cuando cambia el esquema y no se sabe que tablas han cambiado, construir
+# los modelos nuevos en segundo plano mientras las peticiones siguen usando
+# los antiguos (que pueden no coincidir ya con las tablas).
+MODEL_CACHE_BACKGROUND = False
+
+# Directorio donde se guarda una copia compilada del esquema, para que los
+# procesos que arrancan con la misma version no lean las metatablas.
+SCHEMA_SNAPSHOT_DIR = os.path.join(current, 'run', 'schema').replace('\\', '/')
+
+# Numero maximo de consultas compiladas que se guardan por cada version
+# del esquema.
+QUERY_PLAN_CACHE_SIZE = 100
+
+# Resultados de consultas guardados en la cache de django: numero maximo
+# de filas por resultado, y tiempo de vida (en segundos).
+RESULT_CACHE_MAX_ROWS = 1000
+RESULT_CACHE_TIMEOUT = 300
+
+# Cache compartida entre procesos ('django', 'file' o la ruta completa a
+# una clase). Con CACHE_BACKEND = locmem la cache de django no se comparte,
+# asi que se usa un directorio local, limitado a SHARED_CACHE_MAX_BYTES.
+SHARED_CACHE_BACKEND = 'file'
+SHARED_CACHE_DIR = os.path.join(current, 'run', 'shared').replace('\\', '/')
+SHARED_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SHARED_CACHE_TIMEOUT = 300
+
+# Intervalo (en segundos) entre comprobaciones de cambios que afectan
+# a los campos dinamicos materializados. El thread de refresco solo se
+# arranca de forma explicita (ui.models.dbrefresh.start, o la orden
+# "manage.py refresh_materialized"). None para no refrescarlos.
+MATERIALIZED_POLL = None
+
+# Intervalo (en segundos) entre refrescos completos de los campos
+# materializados. None para refrescar solo lo afectado por cada cambio.
+MATERIALIZED_REFRESH = None
+
+# Numero minimo de valores para que una lista literal de un filtro
+# ("campo + [a, b, c...]") se cargue en una tabla temporal en lugar de
+# incluirse en el SQL. None para no usar nunca tablas temporales.
+IN_LIST_TEMP_THRESHOLD = 500
+
+# Numero de filas que se leen en cada consulta al recorrer un conjunto de
+# valores (ver DJQuerySet.stream). None para leerlos todos de una vez.
+STREAM_CHUNK_SIZE = 1000
+
+# Numero maximo de filas que se muestran en el grid de resultados (el
+# resto se pide con el parametro "o", desplazamiento). None para todas.
+GRID_PAGE_SIZE = 500
+
+# Si es True, los grids con mas de GRID_PAGE_SIZE filas se paginan,
+# ordenan y filtran en el servidor (dataTables en modo "server side").
+GRID_SERVER_SIDE = True
@@ -0,0 +1,3 @@
+-- Campos dinamicos materializados
+ALTER TABLE ui_dynamic ADD materialized bool NOT NULL DEFAULT 0;
+INSERT INTO ui_revisionlog (major, minor, rev, stamp, summary) VALUES (0, 0, 2, NOW(), 'Campos dinamicos materializados');
@@ -47,7 +47,7 @@ class TableAdmin(admin.ModelAdmin):
 
 
 class DynamicAdmin(admin.ModelAdmin):
-    list_display = ['related', 'code']
+    list_display = ['related', 'code', 'materialized']
     ordering = ['related']
 
 
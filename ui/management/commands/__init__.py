@@ -0,0 +1,2 @@
+#!/usr/bin/env python
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Compara las dos formas de filtrar por una lista larga de valores:
+
+    - literal: "campo IN (%s, %s, ...)", con la lista en el SQL.
+    - temporal: la lista se carga en una tabla temporal y se hace un
+      join con ella (ver ui.models.dbtemp).
+
+Uso:
+
+    python manage.py inlist_bench <tabla> <campo> [--size=N] [--repeat=R]
+
+<tabla> es el nombre o la pk de la tabla. Los valores se toman de la
+propia columna, completados con valores inexistentes hasta llegar a N.
+
+Ademas de los tiempos, muestra las tablas temporales creadas y las que
+siguen abiertas al terminar cada estrategia (deberian ser 0).
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ui.models import Cache, Table
+from ui.models.dbtemp import ListValues
+from ui.models.dbstats import stats
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--size', type='int', dest='size', default=5000,
+                    help='Numero de valores de la lista'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Numero de repeticiones de cada estrategia'),
+    )
+    help = 'Compara listas IN literales con tablas temporales'
+    args = '<tabla> <campo>'
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Uso: inlist_bench %s' % self.args)
+        name, attrib = args
+        try:
+            if name.isdigit():
+                table = Table.objects.get(pk=int(name))
+            else:
+                table = Table.objects.get(name=name)
+        except (Table.DoesNotExist, Table.MultipleObjectsReturned), details:
+            raise CommandError(unicode(details))
+        Cache.pin()
+        try:
+            model = Cache[table]
+            domd = model._DOMD
+            if attrib not in domd.attribs:
+                raise CommandError('%s no es un campo de %s' %
+                                   (attrib, domd.fullname))
+            column = domd.columns.get(attrib, attrib)
+            values = self.values(domd.objects, column, options['size'])
+            strategies = (
+                ('literal', lambda: values),
+                ('temporal', lambda: ListValues(values)),
+            )
+            for label, build in strategies:
+                self.run(label, domd.objects, column, build, options['repeat'])
+        finally:
+            Cache.release()
+
+    def values(self, objects, column, size):
+        """Valores de la columna, completados hasta "size" elementos"""
+        values = list(objects.values_list(column, flat=True).distinct()[:size])
+        numeric = all(isinstance(x, (int, long)) for x in values)
+        for index in xrange(size - len(values)):
+            values.append(-index-1 if numeric else u'inlist-bench-%d' % index)
+        return tuple(values)
+
+    def run(self, label, objects, column, build, repeat):
+        lookup = '%s__in' % column
+        times, rows = list(), None
+        before = self.tables()
+        for index in xrange(repeat):
+            # cada repeticion usa una conexion nueva, para medir tambien
+            # la creacion de la tabla temporal.
+            connection.close()
+            start = time.time()
+            rows = len(list(objects.filter(**{lookup: build()})))
+            times.append(time.time() - start)
+            # las tablas se cuentan antes de cerrar la conexion, que
+            # las eliminaria en cualquier caso.
+            after = self.tables()
+        sql = objects.filter(**{lookup: build()}).query.as_sql()[0]
+        print ('%-8s rows=%d sql=%d bytes min=%.4fs avg=%.4fs '
+               'temporales=%d abiertas=%d' % (
+               label, rows, len(sql), min(times), sum(times) / len(times),
+               after[0] - before[0], after[1] - before[1]))
+
+    def tables(self):
+        """Tablas temporales creadas, y las que aun no se han eliminado"""
+        counters = stats.snapshot()['counters']
+        created = counters.get('temp.tables', 0)
+        return (created, created - counters.get('temp.drops', 0))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Refresca los campos dinamicos materializados (ver ui.models.dbrefresh).
+
+Uso:
+
+    python manage.py refresh_materialized [--poll=N] [--interval=M]
+
+Sin --poll (ni MATERIALIZED_POLL), recalcula todas las columnas una vez
+y termina. Con --poll, arranca el thread de refresco y se queda
+comprobando los cambios cada N segundos, hasta que se interrumpe.
+"""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ui.models import Cache
+from ui.models import dbrefresh
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--poll', type='int', dest='poll',
+                    default=getattr(settings, 'MATERIALIZED_POLL', None),
+                    help='Segundos entre comprobaciones de cambios'),
+        make_option('--interval', type='int', dest='interval',
+                    default=getattr(settings, 'MATERIALIZED_REFRESH', None),
+                    help='Segundos entre refrescos completos'),
+    )
+    help = 'Refresca los campos dinamicos materializados'
+
+    def handle(self, *args, **options):
+        if not options['poll']:
+            Cache.pin()
+            try:
+                print 'filas actualizadas: %d' % dbrefresh.refresh()
+            finally:
+                Cache.release()
+            return
+        refresher = dbrefresh.start(options['poll'], options['interval'])
+        try:
+            while refresher.isAlive():
+                # join con timeout, para poder interrumpirlo con Ctrl-C
+                refresher.join(options['poll'])
+        except KeyboardInterrupt:
+            pass
@@ -3,15 +3,27 @@
 # -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
 
 
+from django.conf import settings
+
 from .dblog import RevisionLog, ChangeLog, app_label
-from .dbbase import Deferrer
+from .dbbase import Deferrer, DJQuerySet
 from .dbmodel import Table, Link, Field, Dynamic
 from .dbview import TableView, UserView, View
 
-from .dbcache import Cache
-from .dbmodel import instance_factory
+from .dbcache import Cache, Generation
+from .dbmodel import instance_factory, changes_factory
 from .dbmeta import model_factory
+from .dbsnapshot import snapshot_factory
+from . import dbrefresh, dbtemp
 
 Cache.instance_factory = instance_factory
 Cache.model_factory = model_factory
+Cache.changes_factory = changes_factory
+Cache.schema_factory = snapshot_factory
+Cache.warm = getattr(settings, 'MODEL_CACHE_WARMUP', False)
+Cache.background = getattr(settings, 'MODEL_CACHE_BACKGROUND', False)
+Generation.PLANS = getattr(settings, 'QUERY_PLAN_CACHE_SIZE', Generation.PLANS)
+Cache.generation.plans.maxsize = Generation.PLANS
+dbtemp.THRESHOLD = getattr(settings, 'IN_LIST_TEMP_THRESHOLD', dbtemp.THRESHOLD)
+DJQuerySet.CHUNK = getattr(settings, 'STREAM_CHUNK_SIZE', DJQuerySet.CHUNK)
 
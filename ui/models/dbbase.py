@@ -5,14 +5,21 @@
 
 import numbers
 from itertools import chain
+from operator import attrgetter, itemgetter
 from copy import copy
 
-from django.db import models, backend
+from django.db import models, backend, connection
 from django.db.models import Count, Q
+from django.db.models.sql.where import AND
+from django.db.models.signals import post_save, post_delete
 
 from plantillator.data.base import BaseSet, asIter
 from plantillator.data.dataobject import DataType
 
+from .dbversion import versions, data_key
+from .dbdeps import tracking, read_table
+from . import dbtemp
+
 
 class QueryItem(object):
 
@@ -55,12 +62,148 @@ class QueryItem(object):
             raise AttributeError('up')
         return QueryItem(self.pos, "_up__%s" % str(self.field), self.value, False)
 
+    def down(self, refer):
+        """Genera una copia que filtra la tabla padre a traves del hijo
+
+        Solo es posible si el criterio es positivo y no agregado: la logica
+        negativa sobre una relacion inversa no equivale a la original.
+        """
+        if self.agg or not self.pos:
+            raise AttributeError('down')
+        return QueryItem(True, "%s__%s" % (refer, self.field), self.value, False)
+
     def __unicode__(self):
         return u"Query: (%s) %s == %s [agg: %s]" % (
                    str(self.pos), self.field,
                    repr(self.value), str(self.agg)) 
 
 
+class ExistsNode(object):
+
+    """Condicion EXISTS para el WhereNode de una consulta de django
+
+    Comprueba si cada fila de la consulta tiene al menos "minimum" filas
+    hijas en la tabla indicada. Para minimum > 1 se usa un LIMIT, de forma
+    que la base de datos deja de contar al llegar al minimo.
+    """
+
+    def __init__(self, alias, pk, table, fk, pos, minimum):
+        self.alias = alias
+        self.pk = pk
+        self.table = table
+        self.fk = fk
+        self.pos = pos
+        self.minimum = minimum
+
+    def relabel_aliases(self, change_map):
+        self.alias = change_map.get(self.alias, self.alias)
+
+    def as_sql(self, qn=None, connection=connection):
+        quote = connection.ops.quote_name
+        limit = ''
+        if self.minimum > 1:
+            limit = ' LIMIT %d, 1' % (self.minimum - 1)
+        sql = 'EXISTS (SELECT 1 FROM %s WHERE %s.%s = %s.%s%s)' % (
+                  quote(self.table), quote(self.table), quote(self.fk),
+                  quote(self.alias), quote(self.pk), limit)
+        return (sql if self.pos else 'NOT %s' % sql, tuple())
+
+
+class ExistsQ(Q):
+
+    """Objeto Q que agrega un ExistsNode a la consulta"""
+
+    def __init__(self, item):
+        super(ExistsQ, self).__init__()
+        # un conector propio evita que Node.add mezcle este objeto con
+        # otros Q (y pierda el item).
+        self.connector = 'EXISTS'
+        self.item = item
+
+    def __deepcopy__(self, memodict):
+        return ExistsQ(self.item)
+
+    def _combine(self, other, conn):
+        obj = Q()
+        obj.add(self, conn)
+        obj.add(other, conn)
+        return obj
+
+    def add_to_query(self, query, used_aliases):
+        alias = query.get_initial_alias()
+        query.where.add(self.item.node(alias, query.model), AND)
+
+
+class ExistsQuery(object):
+
+    """Consulta sobre el numero de filas hijas, sin agregados
+
+    Equivale a un QueryItem sobre el Count de una subtabla, cuando el
+    criterio es del tipo "tiene hijos", "no tiene hijos", o "tiene al
+    menos N hijos".
+    """
+
+    # operador -> funcion que devuelve (pos, minimo) o None
+    OPERATORS = {
+        'exact': lambda n: (False, 1) if n == 0 else None,
+        'gt':    lambda n: (True, n + 1) if n >= 0 else None,
+        'gte':   lambda n: (True, n) if n >= 1 else None,
+        'lt':    lambda n: (False, n) if n >= 1 else None,
+        'lte':   lambda n: (False, n + 1) if n >= 0 else None,
+    }
+
+    def __init__(self, pos, child, minimum):
+        self.pos = pos
+        self.child = child
+        self.minimum = minimum
+        self.agg = False
+
+    @staticmethod
+    def build(deferred, child):
+        """Traduce un criterio sobre el numero de hijos, si es posible
+
+        Devuelve None si el criterio necesita el Count.
+        """
+        item = deferred('count', True)
+        try:
+            op = item.field.split('__', 1)[1]
+            value = item.value
+            if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+                return None
+            pos, minimum = ExistsQuery.OPERATORS[op](value)
+        except (AttributeError, IndexError, KeyError, TypeError):
+            return None
+        return ExistsQuery(pos == item.pos, child, minimum)
+
+    def node(self, alias, model):
+        meta = self.child._meta
+        return ExistsNode(alias, model._meta.pk.column, meta.db_table,
+                          meta.get_field('_up').column, self.pos, self.minimum)
+
+    def q(self):
+        return ExistsQ(self)
+
+    def __and__(self, other):
+        return AndQuery(self, other)
+
+    def __or__(self, other):
+        return OrQuery(self, other)
+
+    def __invert__(self):
+        return ExistsQuery(not self.pos, self.child, self.minimum)
+
+    def up(self):
+        # no se puede expresar como join, se resuelve con subqueries
+        raise AttributeError('up')
+
+    def down(self, refer):
+        raise AttributeError('down')
+
+    def __unicode__(self):
+        return u"Exists: (%s) %s >= %d" % (
+                   str(self.pos), self.child._DOMD.name, self.minimum)
+
+
 def ChainQuery(op, combinator):
 
     """Query encadenada
@@ -79,6 +222,10 @@ def ChainQuery(op, combinator):
             cls = self.__class__
             return cls(*tuple(q.up() for q in self.queries))
 
+        def down(self, refer):
+            cls = self.__class__
+            return cls(*tuple(q.down(refer) for q in self.queries))
+
         def __iter__(self):
             return self.queries.__iter__()
 
@@ -168,20 +315,20 @@ class Deferrer(object):
         """Comprueba la pertenecia a una lista"""
         if isinstance(arg, DJValueSet):
             # para hacer una subquery, y no sacar los
-            # datos antes de hacer la consulta.
-            arg = arg._queryset.values(arg._attrib)
+            # datos antes de hacer la consulta (ver dbtemp).
+            arg = dbtemp.subquery(arg._queryset, arg._attrib)
         else:
-            arg = asIter(arg)
+            arg = dbtemp.literal(asIter(arg))
         return self._defer(True, 'in', arg)
 
     def __sub__(self, arg):
         """Comprueba la no pertenencia a una lista"""
         if isinstance(arg, DJValueSet):
             # para hacer una subquery, y no sacar los
-            # datos antes de hacer la consulta.
-            arg = arg._queryset.values(arg._attrib)
+            # datos antes de hacer la consulta (ver dbtemp).
+            arg = dbtemp.subquery(arg._queryset, arg._attrib)
         else:
-            arg = asIter(arg)
+            arg = dbtemp.literal(asIter(arg))
         return self._defer(False, 'in', arg)
 
 
@@ -189,8 +336,14 @@ class DJQuerySet(models.query.QuerySet):
 
     """QuerySet que implementa la interfaz de los DataSets"""
 
-    def __init__(self, *arg, **kw):
-        super(DJQuerySet, self).__init__(*arg, **kw)
+    # numero de filas de cada bloque de stream (None para no trocear)
+    CHUNK = 1000
+
+    def __init__(self, model=None, query=None):
+        if query is None:
+            # registra las tablas temporales de cada sentencia (ver dbtemp)
+            query = dbtemp.TempQuery(model, connection)
+        super(DJQuerySet, self).__init__(model, query)
         # criterios que han llevado a la obtencion de este QuerySet
         self._crit = None
  
@@ -201,13 +354,17 @@ class DJQuerySet(models.query.QuerySet):
             if not hasattr(val, '__call__'):
                 val = (Deferrer() == val)
             if key in domd.attribs:
-                additional = val(key, False)
+                # los campos dinamicos materializados se filtran en SQL
+                additional = val(domd.columns.get(key, key), False)
             else:
                 child = domd.children[key]
-                refer = child._meta.object_name.lower()
-                label = '%s_count' % key
-                base  = base.annotate(**{label: Count(refer)})
-                additional = val(label, True)
+                # si es posible, evito el GROUP BY con un EXISTS
+                additional = ExistsQuery.build(val, child)
+                if additional is None:
+                    refer = child._meta.object_name.lower()
+                    label = '%s_count' % key
+                    base  = base.annotate(**{label: Count(refer)})
+                    additional = val(label, True)
             crit.append(additional)
         return (base, crit)
 
@@ -224,10 +381,16 @@ class DJQuerySet(models.query.QuerySet):
         """Obtiene el atributo seleccionado"""
         domd = self._type._DOMD
         if attrib == 'pk' or attrib in domd.attribs:
+            if attrib in domd.columns:
+                # el campo es calculado, pero esta materializado
+                return DJValueSet(self, domd.columns[attrib])
             if attrib in domd.dynamics:
                 # el campo es calculado, no tengo mas remedio
-                # que calcularlo por cada elemento del set.
-                return BaseSet(getattr(x, attrib) for x in self)
+                # que calcularlo por cada elemento del set. Pero antes
+                # precargo las subtablas que usa el codigo.
+                rows = list(self)
+                self.prefetch(rows, (attrib,))
+                return BaseSet(getattr(x, attrib) for x in rows)
             else:
                 # el campo no es calculado, puedo demorar la consulta
                 return DJValueSet(self, attrib)
@@ -253,16 +416,151 @@ class DJQuerySet(models.query.QuerySet):
         return _add(self, other)
 
     def __pos__(self):
-        if len(self) == 1:
-            return self[0]
+        # con LIMIT 2 basta para saber si hay exactamente un elemento
+        rows = self._result_cache
+        if rows is None:
+            rows = list(self[:2])
+        if len(rows) == 1:
+            return rows[0]
         raise IndexError(0)
 
+    def __getitem__(self, k):
+        """Indexa o trocea el resultado, con LIMIT / OFFSET en SQL
+
+        El QuerySet troceado conserva como criterio la pertenencia a sus
+        propias pks, para que .up o la concatenacion con otros sets
+        respeten el limite.
+        """
+        result = super(DJQuerySet, self).__getitem__(k)
+        if isinstance(k, slice) and isinstance(result, DJQuerySet):
+            values = dbtemp.subquery(result, 'pk')
+            result._crit = AndQuery(QueryItem(True, 'pk__in', values, False))
+        return result
+
+    def prefetch(self, rows, attribs):
+        """Precarga las subtablas que usan los campos dinamicos indicados.
+
+        Lee los objetos de cada subtabla con una sola consulta, y asigna
+        a cada fila el QuerySet de sus hijos ya evaluado, tal como lo
+        haria DJModel.__getattr__.
+        """
+        domd, names = self._type._DOMD, set()
+        for attrib in attribs:
+            if attrib in domd.dynamics:
+                names.update(code_names(domd.codes[attrib]))
+        if not names:
+            return
+        children = domd.children.all()
+        pks = tuple(x.pk for x in rows)
+        for name in names:
+            if not pks or name not in children or name in domd.attribs:
+                continue
+            objects = children[name]._DOMD.objects
+            groups = dict((x, list()) for x in pks)
+            for item in objects.filter(_up__in=pks):
+                groups[item._up_id].append(item)
+            for row in rows:
+                if name not in row.__dict__:
+                    prefetched = objects.filter(_up__exact=row.pk).all()
+                    prefetched._crit = row._children_crit()
+                    prefetched._result_cache = groups[row.pk]
+                    setattr(row, name, prefetched)
+
+    def update(self, **kw):
+        rows = super(DJQuerySet, self).update(**kw)
+        bump_data(self.model)
+        return rows
+
+    def iterator(self):
+        if tracking():
+            read_table(self._type._DOMD.pk)
+        # las subconsultas de pertenencia se ejecutan con tablas
+        # temporales (ver dbtemp.TempQuery)
+        return super(DJQuerySet, self).iterator()
+
+    def __iter__(self):
+        # los QuerySets precargados no pasan por iterator
+        if tracking():
+            read_table(self._type._DOMD.pk)
+        return super(DJQuerySet, self).__iter__()
+
+    def count(self):
+        if tracking():
+            read_table(self._type._DOMD.pk)
+        return super(DJQuerySet, self).count()
+
+    def stream(self, attrib=None, chunk=None):
+        """Recorre el resultado por bloques, sin llenar la cache del QuerySet
+
+        Cada bloque es una consulta de hasta "chunk" filas (por defecto,
+        DJQuerySet.CHUNK) ordenadas por pk, a partir de la ultima pk del
+        bloque anterior, de forma que nunca hay en memoria mas de un bloque.
+        Las filas se devuelven en orden de pk.
+
+        Si se indica "attrib", se devuelven solo los valores de ese campo.
+        Si el QuerySet ya esta evaluado, se recorre su cache; si tiene
+        limites (esta troceado), se lee de una vez con iterator.
+        """
+        if attrib is None:
+            key, value = attrgetter('pk'), lambda x: x
+        elif attrib == 'pk':
+            key, value = (lambda x: x), (lambda x: x)
+        else:
+            key, value = itemgetter(0), itemgetter(1)
+        if self._result_cache is not None:
+            for row in self._result_cache:
+                yield row if attrib is None else getattr(row, attrib)
+            return
+        if tracking():
+            read_table(self._type._DOMD.pk)
+        base = self
+        if attrib == 'pk':
+            base = base.values_list('pk', flat=True)
+        elif attrib is not None:
+            base = base.values_list('pk', attrib)
+        chunk = chunk or DJQuerySet.CHUNK
+        if not chunk or self.query.low_mark or self.query.high_mark is not None:
+            for row in base.iterator():
+                yield value(row)
+            return
+        base, last = base.order_by('pk'), None
+        while True:
+            query = base if last is None else base.filter(pk__gt=last)
+            rows = list(query[:chunk])
+            for row in rows:
+                yield value(row)
+            if len(rows) < chunk:
+                return
+            last = key(rows[-1])
+
     @property
     def up(self):
-        # esto siempre lo resuelvo con subqueries
-        crit = QueryItem(True, 'pk__in', self.values('_up_id'), False)
-        parents = self._type._DOMD.parent._DOMD.objects.filter(crit.q()).all()
-        parents._crit = AndQuery(crit)
+        objects = self._type._DOMD.parent._DOMD.objects
+        refer = self._type._meta.object_name.lower()
+        # Si todos los criterios son positivos, los aplico a la tabla
+        # padre a traves de la relacion inversa: un solo join con DISTINCT.
+        # Las cadenas x.up.up... acumulan los prefijos en el criterio, y
+        # se resuelven tambien con una unica consulta.
+        # Solo es valido si _crit describe el QuerySet completo; si es
+        # None no se sabe como se ha filtrado, y uso la subquery.
+        crit = None
+        if self._crit is not None:
+            try:
+                crit = self._crit.down(refer)
+            except AttributeError:
+                pass
+            else:
+                if not getattr(crit, 'queries', True):
+                    crit.append(QueryItem(True, '%s__isnull' % refer,
+                                          False, False))
+        if crit is None:
+            # con agregados o logica negativa, uso subqueries
+            crit = AndQuery(QueryItem(True, 'pk__in',
+                                      self.values('_up_id'), False))
+            parents = objects.filter(crit.q()).all()
+        else:
+            parents = objects.filter(crit.q()).distinct()
+        parents._crit = crit
         return parents
 
     @property
@@ -281,7 +579,6 @@ class DJValueSet(object):
         """Construye un DJValueSet a partir de un DJQuerySet y un atributo"""
         self._queryset = queryset
         self._attrib = attrib
-        self._valueset = queryset.values(attrib)
 
     def __call__(self, arg):
         return DJValueSet(self._queryset(**{self._attrib: arg}), self._attrib)
@@ -294,8 +591,21 @@ class DJValueSet(object):
         return BaseSet(chain(self, other))
 
     def __iter__(self):
-        for item in self._valueset(self._attrib):
-            yield item[self._attrib]
+        # los valores se leen por bloques, sin cargar el resultado entero
+        return self._queryset.stream(self._attrib)
+
+    def __getitem__(self, k):
+        """Indexa o trocea los valores, con LIMIT / OFFSET en SQL"""
+        if isinstance(k, slice):
+            return DJValueSet(self._queryset[k], self._attrib)
+        return self._queryset.values_list(self._attrib, flat=True)[k]
+
+    def count(self):
+        """Numero de valores (uno por fila), con COUNT(*) en SQL"""
+        return self._queryset.count()
+
+    def __len__(self):
+        return self.count()
 
 
 class DJManager(models.Manager):
@@ -318,9 +628,25 @@ class DJModel(DataType(models.Model)):
             raise AttributeError(details)
         else:
             objects = child._DOMD.objects.filter(_up__exact=self.pk).all()
+            objects._crit = self._children_crit()
             setattr(self, attr, objects)
             return objects
 
+    def __setattr__(self, name, value):
+        # si cambia un campo, los valores calculados memorizados durante
+        # la peticion (ver dbmeta) pueden haber quedado obsoletos.
+        if '_dynamics' in self.__dict__ and name in _attnames(type(self)):
+            del self.__dict__['_dynamics']
+        super(DJModel, self).__setattr__(name, value)
+
+    def save(self, *arg, **kw):
+        self.__dict__.pop('_dynamics', None)
+        super(DJModel, self).save(*arg, **kw)
+
+    def _children_crit(self):
+        """Criterio de los hijos de este objeto en cualquier subtabla"""
+        return AndQuery(QueryItem(True, '_up__exact', self.pk, False))
+
     def __add__(self, other):
         return _add(self, other)
 
@@ -341,6 +667,170 @@ class DJModel(DataType(models.Model)):
             pass
 
 
+def _attnames(model):
+    """Nombres de los atributos que guardan los campos de un modelo"""
+    try:
+        return model.__dict__['_ATTNAMES']
+    except KeyError:
+        model._ATTNAMES = frozenset(x.attname for x in model._meta.fields)
+        return model._ATTNAMES
+
+
+def code_names(code):
+    """Devuelve los nombres usados por un codigo compilado y sus lambdas"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names.update(code_names(const))
+    return names
+
+
+# Funciones a las que se avisa cuando cambian los datos de una tabla.
+# Reciben el modelo, la nueva version y la instancia modificada (o None
+# si el cambio afecta a varias filas).
+data_listeners = list()
+
+
+def bump_data(sender, instance=None):
+    """Cambia la version de los datos de la tabla modificada"""
+    domd = getattr(sender, '_DOMD', None)
+    if domd is not None and domd.pk is not None:
+        version = versions.bump(data_key(domd.pk))
+        for listener in data_listeners:
+            listener(sender, version, instance)
+
+
+def _bump_data(sender, instance=None, **kw):
+    if issubclass(sender, DJModel):
+        bump_data(sender, instance)
+
+post_save.connect(_bump_data)
+post_delete.connect(_bump_data)
+
+
+def _aggregated(crit):
+    """Indica si algun componente del criterio usa un agregado"""
+    if isinstance(crit, (AndQuery, OrQuery)):
+        return any(_aggregated(x) for x in crit)
+    return crit.agg
+
+
+def _key(crit):
+    """Clave para detectar criterios repetidos, o None si no la hay"""
+    if isinstance(crit, (AndQuery, OrQuery)):
+        keys = tuple(_key(x) for x in crit)
+        if None in keys:
+            return None
+        return (crit.__class__.__name__,) + keys
+    if isinstance(crit, ExistsQuery):
+        key = ('exists', crit.pos, crit.child._DOMD.pk, crit.minimum)
+    else:
+        value = crit.value
+        if isinstance(value, list):
+            value = tuple(value)
+        key = ('item', crit.pos, crit.field, value, crit.agg)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _members(crit):
+    """Devuelve (columna, valores) si el criterio es "columna IN valores"
+
+    Solo para criterios positivos, sin agregados y con valores literales.
+    Devuelve (None, None) en otro caso.
+    """
+    if type(crit) is not QueryItem or not crit.pos or crit.agg:
+        return (None, None)
+    parts = crit.field.rsplit('__', 1)
+    if len(parts) != 2:
+        return (None, None)
+    column, operator = parts
+    values = crit.value
+    if operator == 'exact':
+        values = (values,)
+    elif operator != 'in':
+        return (None, None)
+    elif isinstance(values, dbtemp.ListValues):
+        values = values.values
+    elif not isinstance(values, (list, tuple)):
+        return (None, None)
+    try:
+        hash(tuple(values))
+    except TypeError:
+        return (None, None)
+    if None in values or any(isinstance(x, (float, bool)) for x in values):
+        return (None, None)
+    return (column, values)
+
+
+def _merge(items):
+    """Une los "columna = x OR columna IN (...)" en un solo IN"""
+    result, merged = list(), dict()
+    for item in items:
+        column, values = _members(item)
+        if column is None:
+            result.append(item)
+        elif column in merged:
+            merged[column].extend(values)
+        else:
+            merged[column] = list(values)
+            result.append(column)
+    for index, item in enumerate(result):
+        if isinstance(item, basestring):
+            values = list(_unique(merged[item], lambda x: x))
+            if len(values) == 1:
+                item = QueryItem(True, '%s__exact' % item, values[0], False)
+            else:
+                values = dbtemp.literal(values)
+                item = QueryItem(True, '%s__in' % item, values, False)
+            result[index] = item
+    return result
+
+
+def _unique(items, key=_key):
+    """Elimina los elementos repetidos, conservando el orden"""
+    seen = set()
+    for item in items:
+        k = key(item)
+        if k is not None:
+            if k in seen:
+                continue
+            seen.add(k)
+        yield item
+
+
+def compact(crit):
+    """Simplifica un arbol de criterios
+
+    Las concatenaciones sucesivas de sets (ver _add) anidan un OrQuery
+    dentro de otro, repitiendo a menudo los mismos campos. Esta funcion:
+
+        - aplana los AndQuery / OrQuery anidados del mismo tipo, y los
+          que solo tienen un componente.
+        - une los criterios "campo = x" / "campo IN (...)" de un OR
+          sobre el mismo campo en un solo IN.
+        - elimina los criterios repetidos.
+    """
+    if not isinstance(crit, (AndQuery, OrQuery)):
+        return crit
+    cls, items = crit.__class__, list()
+    for item in crit:
+        item = compact(item)
+        if isinstance(item, cls):
+            items.extend(item.queries)
+        else:
+            items.append(item)
+    if cls is OrQuery:
+        items = _merge(items)
+    items = list(_unique(items))
+    if len(items) == 1:
+        return items[0]
+    return cls(*items)
+
+
 def _add(one, other):
     """Concatena dos sets"""
     if one._type != other._type:
@@ -352,8 +842,20 @@ def _add(one, other):
         # asi que el resultado de un OR cuando uno de los elementos
         # no esta filtrado, es la tabla entera sin filtrar.
         return objects.all()
-    crit = OrQuery(c1, c2)
+    if _aggregated(c1) or _aggregated(c2):
+        # los criterios sobre agregados solo valen en la consulta que
+        # tiene las anotaciones: hago la union de las pks de ambas.
+        sets = tuple(x if hasattr(x, 'values') else objects.filter(pk=x.pk)
+                     for x in (one, other))
+        crit = QueryItem(True, 'pk__in', dbtemp.union(sets), False)
+        objects = objects.filter(crit.q()).all()
+        objects._crit = AndQuery(crit)
+        return objects
+    crit = compact(OrQuery(c1, c2))
     objects = objects.filter(crit.q()).all()
-    objects._crit = AndQuery(crit)
+    if any(getattr(getattr(x, 'query', None), 'distinct', False)
+           for x in (one, other)):
+        # los criterios a traves de relaciones inversas duplican filas
+        objects = objects.distinct()
+    objects._crit = crit if isinstance(crit, AndQuery) else AndQuery(crit)
     return objects
-
@@ -3,9 +3,13 @@
 # -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
 
 
-from itertools import chain
+from gettext import gettext as _
 from copy import copy
+from itertools import count
+import time
+from threading import Lock, RLock, Thread, local
 
+from django.db import connection
 # HACKISH - HACKISH - HACKISH
 from django.db.models.loading import cache
 
@@ -15,6 +19,10 @@ from plantillator.data.dataobject import DataType
 from plantillator.data.dataobject import MetaData as MD
 
 from .dbbase import DJModel, Deferrer
+from .dbstats import stats
+from .dbversion import versions, data_key
+from .dbdeps import Tracker, Untracked, read_variable
+from .dblru import LRU
 
 
 VARIABLES_TABLE = 'variables'
@@ -24,6 +32,9 @@ VARIABLES_VALUE = 'valor'
 APP_LABEL  = 'auto'
 APP_MODULE = __name__
 
+# Protege el registro de modelos de django, que no es thread-safe
+REGISTRY_LOCK = Lock()
+
 
 class ModelChildren(dict):
 
@@ -44,13 +55,17 @@ class ModelChildren(dict):
         try:
             return dict.__getitem__(self, item)
         except KeyError:
-            pass
+            # si ya estan cargados todos los hijos, no existe.
+            if self.full:
+                raise
         # si falla, intento cargar el objeto de la base de datos
+        stats.incr('children.misses')
         return self.setdefault(item, Cache(None, self.pk, item))
 
     def all(self):
         """Carga en cache todos los modelos hijos de este"""
         if not self.full:
+            stats.incr('children.loads')
             for model in Cache(None, self.pk):
                 self[model._DOMD.name] = model
             self.full = True
@@ -72,8 +87,10 @@ class RootType(DataType(object)):
 
     def __init__(self, *arg, **kw):
         super(RootType, self).__init__(*arg, **kw)
-        self._vartab = None
-        self._varattr = set()
+        self._variables = None
+        self._varpk = None
+        self._varkey = None
+        self._varversion = None
 
     def __getattr__(self, attr):
         """Busca una atributo indicado en el espacio raiz
@@ -82,6 +99,8 @@ class RootType(DataType(object)):
         Si no encuentra nada, busca en las entradas de la tabla especial
         VARIABLES_TABLE.
         """
+        if attr.startswith('__'):
+            raise AttributeError(attr)
         try:
             # lo busco como subtabla
             child_domd = self._type._DOMD.children[attr]._DOMD
@@ -91,33 +110,56 @@ class RootType(DataType(object)):
             return objects
         except KeyError:
             # lo busco como variable
-            self._vartab = self._vartab or Cache(None, None, VARIABLES_TABLE)
-            if self._vartab:
-                try:
-                    objs = self._vartab.objects.all()
-                    item = (+objs(**{VARIABLES_KEY: attr}))
-                except IndexError:
-                    pass
-                else:
-                    result = normalize(getattr(item, VARIABLES_VALUE))
-                    self._varattr.add(attr)
-                    setattr(self, attr, result)
-                    return result
+            with Untracked():
+                variables = self._load_variables()
+            if self._varpk is not None:
+                read_variable(self._varpk, attr.lower())
+            try:
+                return variables[attr.lower()]
+            except KeyError:
+                pass
         raise AttributeError(attr)
 
+    def _load_variables(self):
+        """Carga todas las variables de VARIABLES_TABLE en un diccionario
+
+        Las claves del diccionario estan en minusculas, porque la busqueda
+        de variables no distingue mayusculas. Las variables repetidas se
+        descartan.
+        """
+        variables = self._variables
+        if variables is not None:
+            return variables
+        variables, repeated = dict(), set()
+        try:
+            vartab = Cache(None, None, VARIABLES_TABLE)
+        except KeyError:
+            self._varpk, self._varkey, self._varversion = None, None, None
+        else:
+            self._varpk = vartab._DOMD.pk
+            self._varkey = data_key(self._varpk)
+            self._varversion = versions.get(self._varkey)
+            for item in vartab._DOMD.objects.all():
+                name = unicode(getattr(item, VARIABLES_KEY)).lower()
+                if name in variables:
+                    repeated.add(name)
+                variables[name] = normalize(getattr(item, VARIABLES_VALUE))
+            for name in repeated:
+                del(variables[name])
+        self._variables = variables
+        return variables
+
+    def refresh(self):
+        """Descarta las variables cargadas si la tabla ha cambiado"""
+        if self._varkey is not None:
+            if versions.get(self._varkey) != self._varversion:
+                self._variables = None
+
     def invalidate(self, attr=None):
         """Invalida la cache de objetos, o el item indicado"""
-        children = self._type._DOMD.children
-        if attr:
-            attrs = (attr,)
-            self._varattr.discard(attr)
-        else:
-            attrs = chain(self._varattr, children.keys())
-            self._varattr = set()
-        for attr in attrs:
-            try: delattr(self, attr)
-            except: pass
-        children.invalidate(attr)
+        if not attr or attr == VARIABLES_TABLE:
+            self._variables = None
+        self._type._DOMD.children.invalidate(attr)
 
 
 class RootMeta(MD):
@@ -128,7 +170,30 @@ class RootMeta(MD):
         """Metadatos basicos asociados a un modelo."""
         super(RootMeta, self).__init__(copy(RootType), 'RootType', None)
         self.pk = None
+
+    @property
+    def children(self):
+        """Los hijos del tipo raiz dependen de la generacion de modelos"""
+        return ModelCache.Singleton.current.children
+
+
+class Generation(object):
+
+    """Generacion de modelos
+
+    Agrupa los modelos construidos para una version del esquema, el mapa
+    de hijos del tipo raiz que da acceso a ellos, y los planes de consulta
+    compilados sobre esos modelos (ver ModelCache.query).
+    """
+
+    # Numero maximo de planes de consulta por generacion
+    PLANS = 100
+
+    def __init__(self, version=None):
+        self.version = version
+        self.models = dict()
         self.children = ModelChildren(None)
+        self.plans = LRU(Generation.PLANS)
 
 
 class MetaData(MD):
@@ -179,13 +244,14 @@ class MetaData(MD):
         #
         # Esto es muy malo para nuestros propositos, asi que a continuacion
         # pongo un hack que elimina el modelo de la cache, si existia
-        app_cache = cache.app_models.get(app_label, dict())
-        try:
-            del(app_cache[name.lower()])
-        except KeyError:
-            pass
-        # Ahora ya puedo crear el modelo
-        return type(str(name), (base,), attrs)
+        with REGISTRY_LOCK:
+            app_cache = cache.app_models.get(app_label, dict())
+            try:
+                del(app_cache[name.lower()])
+            except KeyError:
+                pass
+            # Ahora ya puedo crear el modelo
+            return type(str(name), (base,), attrs)
 
 
 class ModelCache(DataContainer):
@@ -225,8 +291,15 @@ class ModelCache(DataContainer):
             self.started = False
             self.instance_factory = None
             self.model_factory = None
+            self.changes_factory = None
+            self.schema_factory = None
+            self.warm = False
+            self.background = False
             self.app_label = APP_LABEL
             self.module = APP_MODULE
+            self.generation = Generation()
+            self.local = local()
+            self.requests = count(1)
             ModelCache.Singleton = self
         return ModelCache.Singleton
 
@@ -234,13 +307,54 @@ class ModelCache(DataContainer):
         if not self.started:
             self.started = True
             super(ModelCache, self).__init__(root_type, deferrer_type, filter_type)
-            self.models = dict()
+            # version del esquema a la que corresponden los modelos
+            self.version = None
+            # version que se esta construyendo en segundo plano
+            self.pending = None
+            # cerrojos para sincronizar y construir los modelos desde
+            # varios threads
+            self.lock = RLock()
+            self.build_locks = dict()
+            self.build_locks_lock = Lock()
+
+    @property
+    def current(self):
+        """Generacion de modelos que debe usar el thread actual"""
+        return getattr(self.local, 'generation', None) or self.generation
+
+    @property
+    def models(self):
+        return self.current.models
+
+    def pin(self):
+        """Fija la generacion de modelos que usara el thread actual
+
+        Se invoca al empezar a atender una peticion, para que la peticion
+        termine con los mismos modelos con que empezo aunque entretanto
+        se haya construido una generacion nueva.
+        """
+        self.local.generation = self.generation
+        self.local.request = self.requests.next()
+
+    def release(self):
+        """Libera la generacion fijada con pin"""
+        self.local.generation = None
+        self.local.request = None
+
+    @property
+    def request(self):
+        """Identificador de la peticion en curso, o None si no hay"""
+        return getattr(self.local, 'request', None)
 
-    def __getitem__(self, instance, loop=set()):
+    def __getitem__(self, instance):
         """Recupera o crea un modelo.
         "instance" debe ser un objeto con al menos dos atributos:
           - "pk": clave primaria del modelo a recuperar.
           - "model": atributo o descriptor que genere el modelo.
+
+        Si varios threads piden a la vez un modelo que no esta en cache,
+        solo uno de ellos lo construye, y el resto esperan a que termine
+        y reciben el mismo modelo.
         """
         pk = instance.pk
         if not pk:
@@ -248,18 +362,43 @@ class ModelCache(DataContainer):
             # de cache y para tener el nombre de la tabla a mano.
             raise ValueError(_('pk es Nulo'))
         try:
-            return self.models[pk]
+            model = self.models[pk]
         except KeyError:
             pass
+        else:
+            stats.incr('models.hits')
+            return model
         # para evitar referencias circulares, implementamos un mecanismo
-        # antibucles
+        # antibucles (por thread).
+        try:
+            loop = self.local.pks
+        except AttributeError:
+            loop = self.local.pks = set()
         if pk in loop:
             raise ValueError, _("Referencia circular (%s)") % repr(pk)
-        loop.add(pk)
-        try:
-            return self.models.setdefault(pk, self.model_factory(instance))
-        finally:
-            loop.remove(pk)
+        # Un modelo solo depende de sus ancestros, asi que los cerrojos
+        # se toman siempre en el mismo orden (de la tabla a la raiz) y
+        # no pueden bloquearse entre si.
+        with self._build_lock(pk):
+            try:
+                # otro thread puede haberlo construido mientras esperabamos
+                return self.models[pk]
+            except KeyError:
+                pass
+            stats.incr('models.misses')
+            loop.add(pk)
+            start = time.time()
+            try:
+                model = self.models.setdefault(pk, self.model_factory(instance))
+            finally:
+                loop.remove(pk)
+            stats.time('build.%s' % model._DOMD.fullname, time.time() - start)
+            return model
+
+    def _build_lock(self, pk):
+        """Devuelve el cerrojo que protege la construccion de un modelo"""
+        with self.build_locks_lock:
+            return self.build_locks.setdefault(pk, Lock())
 
     def __call__(self, instance_pk=None, parent_pk=None, instance_name=None):
         """Localiza el modelo asociado a una cierta instancia.
@@ -283,27 +422,183 @@ class ModelCache(DataContainer):
     def get(self, pk, defval=None):
         return self.models.get(pk, defval)
 
+    def query(self, q):
+        """Evalua una consulta, reutilizando el plan si ya se compilo
+
+        El resultado de evaluar una consulta que no lee datos (un QuerySet
+        sin evaluar, construido solo a partir de los modelos) se guarda
+        como plan en la generacion actual. Las siguientes evaluaciones de
+        la misma consulta devuelven una copia del plan, sin analizar la
+        consulta ni resolver los nombres de nuevo.
+
+        Las consultas que leen datos mientras se evaluan (por ejemplo,
+        variables o subconsultas ya evaluadas) no se guardan.
+        """
+        plans = self.current.plans
+        plan = plans.get(q)
+        if plan is not None:
+            stats.incr('plans.hits')
+            result = plan._clone()
+            result._crit = plan._crit
+            return result
+        stats.incr('plans.misses')
+        with Tracker() as deps:
+            result = self.evaluate(q)
+        if (hasattr(result, '_clone') and hasattr(result, '_crit') and
+            result._result_cache is None and
+            not (deps.tables or deps.rows or deps.variables)):
+            plan = result._clone()
+            plan._crit = result._crit
+            plans.set(q, plan)
+        return result
+
     def invalidate(self, instance=None):
         """Elimina el modelo de la instancia indicada y sus ancestros.
         "instance" debe ser un objeto con al menos dos atributos:
           - "pk": clave primaria del modelo a recuperar.
           - "model": atributo o descriptor que genere el modelo.
         """
+        self.current.plans.clear()
         if instance is None:
             self.models.clear()
             self.data.invalidate()
         else:
+            stats.incr('invalidations.table')
             model = self.pop(instance.pk)
             if model:
                 domd = model._DOMD
-                parent, top = domd.parent, domd.top
-                # elimino la entrada de "children" en el ancestro
-                # (solo si el ancestro no es el root; en otro caso, basta
-                # con el self.data.invalidate que se hace abajo)
-                if parent != top:
-                    parent._DOMD.children.invalidate(domd.name)
-                self.data.invalidate(top._DOMD.name)
- 
+                self.forget(domd.parent._DOMD.pk, domd.name)
+
+    def forget(self, parent_pk, name):
+        """Elimina la entrada "name" del mapa de hijos de un modelo
+
+        Si el modelo padre es el raiz (parent_pk == None), se invalida el
+        atributo correspondiente de self.data.
+        """
+        if parent_pk is None:
+            self.data.invalidate(name)
+        else:
+            parent = self.models.get(parent_pk)
+            if parent is not None:
+                parent._DOMD.children.invalidate(name)
+
+    def update(self, version):
+        """Sincroniza la cache con la version de esquema indicada
+
+        Si se dispone de "changes_factory", solo se eliminan de la cache
+        los modelos afectados por los cambios registrados entre la version
+        actual y la nueva. En otro caso, se invalida la cache entera.
+
+        changes_factory se invoca con dos versiones, y debe devolver una
+        lista de tuplas (pk, instancia) con las tablas afectadas por los
+        cambios entre ambas. Si la tabla ya no existe, la instancia debe
+        ser None. Si no es posible determinar las tablas afectadas, debe
+        devolver None.
+
+        Si no se pueden determinar las tablas afectadas, self.background
+        es True y ya hay una generacion de modelos en uso, la nueva
+        generacion se construye en segundo plano, y mientras tanto se sigue
+        usando la antigua (con los modelos del esquema anterior).
+        """
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version or version == self.pending:
+                return
+            changes = self._changes(version)
+            if (changes is None and self.background and
+                self.version is not None):
+                stats.incr('invalidations.background')
+                self.pending = version
+                rebuild = Thread(target=self._rebuild, args=(version,))
+                rebuild.setDaemon(True)
+                rebuild.start()
+            else:
+                # si habia una reconstruccion en marcha, se descarta
+                self.pending = None
+                self._update(version, changes)
+
+    def _changes(self, version):
+        """Tablas afectadas por los cambios hasta "version", o None"""
+        if self.version is None or self.changes_factory is None:
+            return None
+        return self.changes_factory(self.version, version)
+
+    def _rebuild(self, version):
+        """Construye una generacion de modelos nueva, y la pone en uso"""
+        generation = Generation(version)
+        self.local.generation = generation
+        try:
+            self.warmup(version)
+        except Exception:
+            # si falla la construccion, la generacion nueva se queda
+            # vacia y los modelos se construiran bajo demanda.
+            generation = Generation(version)
+        finally:
+            self.local.generation = None
+            connection.close()
+        with self.lock:
+            if self.pending == version:
+                # cambio de generacion: una sola asignacion.
+                self.generation = generation
+                self.version, self.pending = version, None
+
+    def _update(self, version, changes):
+        self.version = self.generation.version = version
+        if changes is None:
+            stats.incr('invalidations.full')
+            self.invalidate()
+            if self.warm and self.schema_factory is not None:
+                self.warmup()
+        else:
+            stats.incr('invalidations.delta')
+            for pk, instance in changes:
+                self.invalidate(instance or _Key(pk))
+                if instance is not None:
+                    # la tabla puede haber cambiado de nombre o de padre
+                    self.forget(instance.parent_id, instance.name)
+
+    def warmup(self, version=None):
+        """Construye todos los modelos del esquema de una vez
+
+        schema_factory se invoca con la version de esquema indicada (o la
+        actual), y debe devolver todas las instancias que definen modelos,
+        ordenadas de forma que cada instancia aparezca despues de su padre,
+        y a ser posible con todos sus datos ya cargados.
+
+        Ademas de construir los modelos, rellena los mapas de hijos, para
+        que ModelChildren.all no tenga que consultar la base de datos.
+        """
+        maps, failed = [self.root._DOMD.children], set()
+        if version is None:
+            version = self.version
+        for instance in self.schema_factory(version):
+            try:
+                model = self[instance]
+            except Exception:
+                # la tabla se intentara construir de nuevo cuando se
+                # acceda a ella; mientras, su padre no esta completo.
+                failed.add(instance.parent_id)
+                continue
+            domd = model._DOMD
+            domd.parent._DOMD.children.setdefault(domd.name, model)
+            maps.append(domd.children)
+        for children in maps:
+            if children.pk not in failed:
+                children.full = True
+
+    def stats(self):
+        """Devuelve las estadisticas de uso de la cache"""
+        data = stats.snapshot()
+        data['models'] = {
+            'live': len(self.models),
+            'registered': len(cache.app_models.get(self.app_label, ())),
+            'version': self.version,
+            'pending': self.pending,
+            'plans': len(self.current.plans),
+        }
+        return data
+
     def pop(self, pk):
         """Elimina un modelo y sus descendientes"""
         try:
@@ -313,8 +608,21 @@ class ModelCache(DataContainer):
         else:
             for child in model._DOMD.children.values():
                 self.pop(child._DOMD.pk)
+            # los descendientes pueden estar en cache sin estar en el
+            # mapa de hijos (por ejemplo, si se cargaron con Cache(pk))
+            for child in self.models.values():
+                if child._DOMD.parent is model:
+                    self.pop(child._DOMD.pk)
             return model
 
 
+class _Key(object):
+
+    """Referencia a un modelo por clave primaria"""
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
 Cache = ModelCache(RootMeta()._type, Deferrer, None)
 
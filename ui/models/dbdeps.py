@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Seguimiento de dependencias de los campos dinamicos
+
+Mientras se evalua el codigo de un campo dinamico, un Tracker registra
+que datos lee la expresion:
+
+    - tables: tablas consultadas (cualquier cambio en ellas afecta).
+    - rows: filas leidas directamente, como tuplas (tabla, fila).
+    - variables: nombres de variables de VARIABLES_TABLE.
+
+El indice Dependencies invierte esa informacion: dado un cambio en una
+tabla, fila o variable, devuelve los campos (o las filas concretas de
+cada campo) cuyo valor hay que recalcular.
+
+Los cambios hechos en este proceso se conocen con precision de fila,
+a traves de las signals de django. Los hechos en otros procesos solo se
+conocen por la version de los datos de la tabla (ver dbversion), y se
+tratan como cambios en la tabla completa.
+"""
+
+from threading import Lock, local
+
+_local = local()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = list()
+        return _local.stack
+
+
+class Tracker(object):
+
+    """Registro de los datos leidos por una expresion
+
+    Se usa como contexto de un bloque "with". Los trackers se pueden
+    anidar, y cada lectura se registra en todos los activos.
+    """
+
+    def __init__(self):
+        self.tables = set()
+        self.rows = set()
+        self.variables = set()
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _stack().pop()
+
+
+class Untracked(object):
+
+    """Suspende el seguimiento de dependencias dentro de un bloque "with"
+
+    Se usa para las lecturas internas de las caches, que no deben
+    contar como dependencias de la expresion que las provoca.
+    """
+
+    def __enter__(self):
+        self.saved, _local.stack = _stack(), list()
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.stack = self.saved
+
+
+def tracking():
+    """Indica si hay algun Tracker activo en el thread actual"""
+    return bool(getattr(_local, 'stack', None))
+
+
+class Recording(object):
+
+    """Activa el registro de dependencias de los campos materializados
+
+    Solo el refresco de los campos materializados (ver dbrefresh) necesita
+    el indice de dependencias; el resto de evaluaciones no lo alimentan.
+    """
+
+    def __enter__(self):
+        self.saved = recording()
+        _local.recording = True
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.recording = self.saved
+
+
+def recording():
+    """Indica si se estan registrando dependencias en el thread actual"""
+    return getattr(_local, 'recording', False)
+
+
+def read_table(table_pk):
+    for tracker in _stack():
+        tracker.tables.add(table_pk)
+
+
+def read_row(table_pk, row_pk):
+    for tracker in _stack():
+        tracker.rows.add((table_pk, row_pk))
+
+
+def read_variable(table_pk, name):
+    for tracker in _stack():
+        tracker.variables.add((table_pk, name))
+
+
+class Dependencies(object):
+
+    """Indice inverso de dependencias
+
+    Los objetivos son tuplas (modelo, campo, fila), siendo "modelo" la pk
+    de la tabla que contiene el campo dinamico, y "fila" la pk de la fila
+    cuyo valor se ha calculado.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.tables = dict()
+            self.rows = dict()
+            self.variables = dict()
+
+    def add(self, tracker, target):
+        """Registra las dependencias de un objetivo"""
+        field = target[:2]
+        with self.lock:
+            for table in tracker.tables:
+                self.tables.setdefault(table, set()).add(field)
+            for row in tracker.rows:
+                self.rows.setdefault(row, set()).add(target)
+            for variable in tracker.variables:
+                self.variables.setdefault(variable, set()).add(field)
+
+    def known(self):
+        """Devuelve las tablas de las que depende algun campo"""
+        with self.lock:
+            tables = set(self.tables)
+            tables.update(x[0] for x in self.rows)
+            tables.update(x[0] for x in self.variables)
+        return tables
+
+    def readers(self, table_pk):
+        """Devuelve los campos (modelo, campo) que consultan la tabla
+
+        Solo incluye las dependencias de tabla completa (consultas), no
+        las de filas o variables concretas.
+        """
+        with self.lock:
+            return set(self.tables.get(table_pk, tuple()))
+
+    def changed(self, table_pk, row_pk=None, variable=None):
+        """Devuelve los objetivos afectados por un cambio
+
+        Devuelve una tupla (campos, filas), donde "campos" es un
+        conjunto de tuplas (modelo, campo) que hay que recalcular
+        enteros, y "filas" un conjunto de objetivos concretos.
+
+        Si no se indica la fila, el cambio afecta a la tabla completa.
+        """
+        with self.lock:
+            fields = set(self.tables.get(table_pk, tuple()))
+            rows = set()
+            if row_pk is None:
+                for (table, row), targets in self.rows.iteritems():
+                    if table == table_pk:
+                        fields.update(x[:2] for x in targets)
+                for (table, name), targets in self.variables.iteritems():
+                    if table == table_pk:
+                        fields.update(targets)
+            else:
+                rows.update(self.rows.get((table_pk, row_pk), tuple()))
+                if variable is not None:
+                    key = (table_pk, variable)
+                    fields.update(self.variables.get(key, tuple()))
+        return (fields, rows)
+
+
+dependencies = Dependencies()
@@ -4,13 +4,55 @@
 
 from gettext import gettext as _
 from datetime import datetime
-from django.db import models, connection
+from functools import wraps
+from threading import local
+from django.db import models, connection, transaction
 
 from .dbfields import PickledObjectField
+from .dbversion import versions, SCHEMA_KEY
 
 
 app_label = 'ui'
 
+_local = local()
+
+
+def after_commit(func, *args):
+    """Ejecuta func(*args) al terminar la transaccion en curso
+
+    Solo se aplaza dentro de un metodo decorado con commit_on_success (el
+    de este modulo). En otro caso, se ejecuta en el momento.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        func(*args)
+    else:
+        pending.append((func, args))
+
+
+def commit_on_success(func):
+    """Como transaction.commit_on_success, pero al terminar ejecuta las
+    acciones aplazadas con after_commit.
+
+    Sirve para publicar versiones (de esquema o de datos) solo cuando los
+    cambios ya son visibles para el resto de procesos. Las acciones se
+    ejecutan tambien si hay un error: tras el rollback, avisar de mas
+    no hace dano. Si hay varios metodos anidados, las ejecuta el exterior.
+    """
+    managed = transaction.commit_on_success(func)
+    @wraps(func)
+    def wrapper(*arg, **kw):
+        if getattr(_local, 'pending', None) is not None:
+            return managed(*arg, **kw)
+        _local.pending = list()
+        try:
+            return managed(*arg, **kw)
+        finally:
+            pending, _local.pending = _local.pending, None
+            for callback, args in pending:
+                callback(*args)
+    return wrapper
+
 
 class RevisionManager(models.Manager):
 
@@ -62,6 +104,20 @@ class ChangeLogManager(models.Manager):
             c.save()
             return c
 
+    def version(self):
+        """Devuelve la version actual del esquema
+
+        La version es el id del ultimo ChangeLog, y se lee del canal de
+        versiones compartido, de forma que no es necesario consultar la
+        base de datos en cada peticion. Si el canal no tiene el dato, se
+        obtiene de la base de datos y se publica.
+        """
+        version = versions.peek(SCHEMA_KEY)
+        if version is None:
+            version = self.current().pk
+            versions.publish(SCHEMA_KEY, version)
+        return version
+
 
 class ChangeLog(models.Model):
 
@@ -92,6 +148,9 @@ class ChangeLog(models.Model):
         super(ChangeLog, self).save()
         cursor = self.cursor or connection.cursor()
         cursor.execute(self.sql, self.params or tuple())
+        # aviso al resto de procesos de que el esquema ha cambiado, pero
+        # solo cuando el ChangeLog (y lo que describe) ya es visible.
+        after_commit(versions.publish, SCHEMA_KEY, self.pk)
 
     class Meta:
         verbose_name = _('cambio')
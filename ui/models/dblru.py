@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Cache LRU acotada, en memoria del proceso
+"""
+
+from itertools import count
+from threading import Lock
+
+
+class LRU(object):
+
+    """Diccionario acotado que descarta las entradas menos usadas
+
+    Cada entrada puede tener un peso (por defecto, 1). Cuando la suma de
+    los pesos supera "maxsize", se descartan las entradas usadas hace
+    mas tiempo hasta volver por debajo del limite.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.ticks = count()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.items = dict()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, defval=None):
+        with self.lock:
+            try:
+                value, weight, tick = self.items[key]
+            except KeyError:
+                return defval
+            self.items[key] = (value, weight, self.ticks.next())
+            return value
+
+    def set(self, key, value, weight=1):
+        if weight > self.maxsize:
+            return
+        with self.lock:
+            self._pop(key)
+            self.items[key] = (value, weight, self.ticks.next())
+            self.size += weight
+            if self.size > self.maxsize:
+                # descarto las entradas mas antiguas
+                items = sorted(self.items.iteritems(), key=lambda x: x[1][2])
+                for key, (value, weight, tick) in items:
+                    if self.size <= self.maxsize:
+                        break
+                    self._pop(key)
+
+    def pop(self, key):
+        with self.lock:
+            return self._pop(key)
+
+    def _pop(self, key):
+        try:
+            value, weight, tick = self.items.pop(key)
+        except KeyError:
+            return None
+        self.size -= weight
+        return value
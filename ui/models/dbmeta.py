@@ -20,6 +20,7 @@ from plantillator.data.dataobject import Fallback
 from .dbcache import Cache
 from .dbcache import MetaData as MD
 from .dbmodel import Dynamic
+from .dbdeps import Tracker, tracking, recording, read_row, dependencies
 
 
 def to_unicode(self):
@@ -29,6 +30,30 @@ def to_unicode(self):
     return u", ".join(u"%s: %s" % (x, repr(self.get(x, None))) for x in atts)
 
 
+def compile_code(field, fullname):
+    """Compila el codigo dinamico de un campo
+
+    El resultado se guarda en el atributo "_compiled" del campo, para
+    no recompilar el codigo si ya se habia hecho (o si el campo se ha
+    cargado de una copia del esquema en disco).
+    """
+    try:
+        return field._compiled
+    except AttributeError:
+        source_id = '<%s.%s.code>' % (fullname, field.name)
+        field._compiled = compile(field.code, source_id, 'eval')
+        return field._compiled
+
+
+def read_ancestors(meta, instance):
+    """Registra como dependencias la fila y las de sus ancestros"""
+    read_row(meta.pk, instance.pk)
+    for parent in reversed(meta.parents):
+        read_row(parent._DOMD.pk, instance._up_id)
+        # los ancestros vienen en la misma consulta (select_related)
+        instance = instance._up
+
+
 class MetaData(MD):
 
     """Metadatos asociados a una tabla de cliente"""
@@ -63,6 +88,7 @@ class MetaData(MD):
         pk, name = instance.pk, instance.name
         self.comment = instance.comment
         self.dbattribs = dict()
+        self.columns = dict()
         self.comments = dict()
         model_attrs = {
             '_annotations': models.TextField(blank=True, null=True,
@@ -81,6 +107,7 @@ class MetaData(MD):
         super(MetaData, self).__init__(pk, name, model_attrs, parent)
         self.attribs = attribs
         self.dynamics = set(x[0].name for x in dynamics)
+        self.codes = dict((x[0].name, x[1]) for x in dynamics)
         self.identity = tuple(x.name for x in instance.uniques)
         if not self.identity:
             self.identity = ('pk',)
@@ -120,35 +147,70 @@ class MetaData(MD):
           - Devuelve una lista de tuplas (Field, codigo "compilado")
         """
         dynamics = list()
-        for field in instance.field_set.all():
+        for field in instance.fields:
             name, _name, code = field.name, field._name, field.code
             model_attrs[_name] = field.field
             self.dbattribs[name] = _name
             self.comments[name] = field.comment
             attribs.add(name)
             if code is not None:
-                source_id = '<%s.%s.code>' % (instance.fullname, name)
-                code = compile(code, source_id, 'eval')
+                code = compile_code(field, instance.fullname)
                 dynamics.append((field, code))
+                if field.materialized:
+                    # columna donde dbrefresh guarda el valor calculado
+                    model_attrs[field._matname] = field.matfield
+                    self.columns[name] = field._matname
         return dynamics
 
-    def _build_property(self, name, hidden, code):
+    def _build_property(self, name, hidden, code, column=None):
         """Crea una propiedad dinamica
 
         Crea una propiedad para que, cuando se acceda al atributo "name",
         se ejecute el codigo "code", y cuando se modifique el valor del
         atributo "name", se guarde en "hidden".
+
+        Durante una peticion (ver ModelCache.pin), el valor calculado se
+        guarda en la instancia, y el codigo solo se evalua una vez. Si se
+        modifica algun campo de la instancia o se salva, los valores
+        guardados se descartan (ver DJModel.__setattr__).
+
+        Si el campo esta materializado en "column" y se esta refrescando
+        (ver dbdeps.Recording), se registran los datos que lee el codigo
+        en el indice de dependencias.
         """
+        meta, pk = self, self.pk
+        def evaluate(self):
+            try:
+                local = Fallback(Cache.data, {'self': self}, 1)
+                return eval(code, Cache.glob, local)
+            except:
+                return None
         def fget(self):
             value = getattr(self, hidden)
             if value is None:
+                stamp = Cache.request
+                memo = self.__dict__.setdefault('_dynamics', dict())
                 try:
-                    local = Fallback(Cache.data, {'self': self}, 1)
-                    value = eval(code, Cache.glob, local)
-                except:
-                    value = None
+                    saved, value = memo[name]
+                    if saved == stamp and stamp is not None:
+                        return value
+                except KeyError:
+                    pass
+                record = column is not None and recording()
+                if record or tracking():
+                    # las lecturas del codigo cuentan para este campo
+                    # y para los que lo estan evaluando
+                    with Tracker() as deps:
+                        read_ancestors(meta, self)
+                        value = evaluate(self)
+                    if record:
+                        dependencies.add(deps, (pk, name, self.pk))
+                else:
+                    value = evaluate(self)
+                memo[name] = (stamp, value)
             return value
         def fset(self, value):
+            self.__dict__.get('_dynamics', dict()).pop(name, None)
             setattr(self, hidden, value)
         return property(fget, fset)
 
@@ -159,7 +221,8 @@ class MetaData(MD):
         """
         for field, code in dynamics:
             name, hidden = field.name, field._name
-            prop = self._build_property(name, hidden, code)
+            column = self.columns.get(name)
+            prop = self._build_property(name, hidden, code, column)
             setattr(self._type, name, prop)
 
     def _get_links(self, instance, model_attrs, attribs):
@@ -171,7 +234,7 @@ class MetaData(MD):
           - Devuelve una lista campos enlazados
         """
         groups = dict()
-        for link in instance.link_set.select_related('related').all():
+        for link in instance.links:
             name, _name = link.name, link._name
             self.dbattribs[name] = _name
             self.comments[name] = link.comment
@@ -228,7 +291,7 @@ class MetaData(MD):
         name, relname = link._name, link.related._name
         def accessor(item):
             return getattr(item, name)
-        return (link.related.table.pk, (relname, accessor))
+        return (link.related.table_id, (relname, accessor))
 
     def _build_filter(self, link, table_set):
         """Construye un criterio de filtrado para el campo
@@ -10,9 +10,9 @@ from collections import namedtuple
 from copy import copy
 import re
 
-from django.db import models, transaction, connection
+from django.db import models, connection
 
-from .dblog import app_label
+from .dblog import app_label, ChangeLog, commit_on_success
 from .dbcache import Cache
 from .dbraw import *
 from .dbfields import *
@@ -47,8 +47,27 @@ class Table(models.Model):
         """Nombre descriptivo completo"""
         return u".".join(x.name for x in self.path)
 
+    @property
+    def fields(self):
+        """Campos de la tabla (los precargados, si los hay)"""
+        try:
+            return self._fields
+        except AttributeError:
+            return self.field_set.all()
+
+    @property
+    def links(self):
+        """Enlaces de la tabla (los precargados, si los hay)"""
+        try:
+            return self._links
+        except AttributeError:
+            return self.link_set.select_related('related').all()
+
     @property
     def uniques(self):
+        if hasattr(self, '_fields') and hasattr(self, '_links'):
+            return (x for x in chain(self._fields, self._links)
+                      if x.index == UNIQUE_INDEX)
         unique_fields = self.field_set.filter(index=UNIQUE_INDEX)
         unique_links  = self.link_set.filter(index=UNIQUE_INDEX)
         return chain(unique_fields, unique_links)
@@ -62,7 +81,7 @@ class Table(models.Model):
     def __unicode__(self):
         return self.fullname
 
-    @transaction.commit_on_success
+    @commit_on_success
     def save(self):
         """Crea o modifica la tabla en la base de datos"""
         old_instance, old_model = None, None
@@ -77,7 +96,7 @@ class Table(models.Model):
             Cache.invalidate(old_instance)
         post_save_table(old_instance, old_model, self)
 
-    @transaction.commit_on_success
+    @commit_on_success
     def delete(self):
         """Borra las tablas"""
         # borro antes los objetos derivados, porque una vez borrada la
@@ -142,7 +161,7 @@ class BaseField(models.Model):
         """Se invoca cuando se salva un campo modificado"""
         pass
 
-    @transaction.commit_on_success
+    @commit_on_success
     def save(self):
         """Modifica los campos de las tablas en la bd"""
         sender, old, changed = self.__class__, None, True
@@ -157,7 +176,7 @@ class BaseField(models.Model):
         # actualizo el modelo
         Cache.invalidate(self.table)
 
-    @transaction.commit_on_success
+    @commit_on_success
     def delete(self):
         old = self.__class__.objects.get(pk=self.pk)
         old_table = old.table
@@ -189,7 +208,10 @@ class FieldManager(CatchManager):
         d, f = Dynamic._meta.db_table, Field._meta.db_table
         raw_set = super(FieldManager, self).get_query_set()
         return raw_set.extra(
-            select = { '_code': '`%s`.`code`' % d },
+            select = {
+                '_code': '`%s`.`code`' % d,
+                '_materialized': 'COALESCE(`%s`.`materialized`, 0)' % d,
+            },
             join = ['LEFT JOIN %s ON (%s.related_id = %s.id)' % (d, d, f)]
         )
 
@@ -254,6 +276,28 @@ class Field(BaseField):
                 self._code = None
             return self._code
 
+    @property
+    def materialized(self):
+        """Indica si el valor del campo dinamico se guarda en una columna"""
+        try:
+            return bool(self._materialized)
+        except AttributeError:
+            try:
+                self._materialized = self.dynamic.materialized
+            except Dynamic.DoesNotExist:
+                self._materialized = False
+            return bool(self._materialized)
+
+    @property
+    def _matname(self):
+        """Nombre de la columna con el valor materializado"""
+        return '_%s_mat' % str(self.name)
+
+    @property
+    def matfield(self):
+        """Campo de la columna con el valor materializado (admite NULL)"""
+        return self._field(verbose_name=self.name, null=True, blank=True)
+
     @property
     def _name(self):
         """Modifica el nombre si tenemos asociado codigo dinamico"""
@@ -355,6 +399,8 @@ class Dynamic(models.Model):
     objects = CatchManager()
     related = models.OneToOneField(Field, verbose_name=_('ligado a'))
     code = models.CharField(max_length=1024, verbose_name=_('codigo'))
+    materialized = models.BooleanField(default=False,
+                       verbose_name=_('materializado'))
 
     class Meta:
         verbose_name = _('campo dinamico')
@@ -368,16 +414,29 @@ class Dynamic(models.Model):
     def name(self):
         return '_%s' % str(self.related.name)
 
-    @transaction.commit_on_success
+    @commit_on_success
     def save(self):
-        created = not self.pk
+        created, old = not self.pk, None
+        if not created:
+            old = Dynamic.objects.get(pk=self.pk)
         super(Dynamic, self).save()
         if created:
             update_dynamic(self.related, self, True)
+        materialized = bool(old and old.materialized)
+        changed = bool(old) and old.code != self.code
+        if materialized != bool(self.materialized):
+            update_materialized(self.related, self.materialized)
+        elif materialized and changed:
+            refresh_materialized(self.related)
+        if changed:
+            update_code(self.related)
+        if created or changed or materialized != bool(self.materialized):
             Cache.invalidate(self.related.table)
 
-    @transaction.commit_on_success
+    @commit_on_success
     def delete(self):
+        if self.materialized:
+            update_materialized(self.related, False)
         update_dynamic(self.related, self, False)
         super(Dynamic, self).delete()
         Cache.invalidate(self.related.table)
@@ -408,6 +467,107 @@ def instance_factory(pk, parent_pk, name):
         elif name is not None:
             return Table.objects.get(parent=parent_pk, name=name)
         else:
-            return Table.objects.filter(parent=parent_pk)
+            return children_factory(parent_pk)
     except Table.DoesNotExist:
         raise KeyError(pk or name or parent_pk)
+
+
+def children_factory(parent_pk):
+    """Lee todas las tablas hijas de la indicada, precargadas.
+
+    Lee las tablas, sus campos y sus enlaces con un numero fijo de
+    consultas, en lugar de hacerlo tabla por tabla al construir cada
+    modelo. Devuelve las tablas precargadas (ver "preload").
+    """
+    tables = list(Table.objects.filter(parent=parent_pk))
+    if not tables:
+        return tables
+    pks = tuple(x.pk for x in tables)
+    fields = list(Field.objects.filter(table__in=pks).order_by('pk'))
+    links = list(Link.objects.filter(table__in=pks).order_by('pk'))
+    tables = preload(tables, fields, links)
+    # los campos enlazados pueden pertenecer a otras tablas
+    missing = set(x.related_id for x in links) - set(x.pk for x in fields)
+    if missing:
+        related = dict((x.pk, x) for x in Field.objects.filter(pk__in=missing))
+        for link in links:
+            if link.related_id in related:
+                link._related_cache = related[link.related_id]
+    # todas las tablas comparten la misma instancia del padre, asi que
+    # los ancestros solo se leen una vez.
+    if parent_pk is not None:
+        parent = Table.objects.get(pk=parent_pk)
+        for table in tables:
+            table._parent_cache = parent
+    return tables
+
+
+def changes_factory(since, until):
+    """Localiza las tablas afectadas por los cambios de esquema.
+
+    Tal como se indica en ModelCache.update, devuelve una lista de tuplas
+    (pk, instancia) con las tablas modificadas por los ChangeLog
+    registrados entre las versiones "since" y "until". Si la tabla ya no
+    existe, la instancia es None.
+
+    Si alguno de los cambios no puede asociarse a una tabla, devuelve None.
+    """
+    lower, upper = min(since, until), max(since, until)
+    changes = ChangeLog.objects.filter(pk__gt=lower, pk__lte=upper)
+    pks = set()
+    for sql in changes.values_list('sql', flat=True):
+        pk = sql_table_pk(sql)
+        if pk is None:
+            return None
+        pks.add(pk)
+    if not pks:
+        return tuple()
+    tables = dict((x.pk, x) for x in Table.objects.filter(pk__in=pks))
+    return tuple((pk, tables.get(pk)) for pk in pks)
+
+
+def preload(tables, fields, links):
+    """Asocia a cada tabla sus campos y enlaces ya leidos.
+
+    Rellena las caches de las foreign keys (parent, table, related) con
+    las instancias recibidas, de forma que construir los modelos de
+    esas tablas no requiera consultas adicionales.
+
+    Devuelve la lista de tablas ordenada de forma que cada tabla aparezca
+    siempre despues de su padre.
+    """
+    bypk = dict((x.pk, x) for x in tables)
+    for table in tables:
+        table._fields, table._links = list(), list()
+        if table.parent_id in bypk:
+            table._parent_cache = bypk[table.parent_id]
+    for field in fields:
+        table = bypk[field.table_id]
+        field._table_cache = table
+        table._fields.append(field)
+    related = dict((x.pk, x) for x in fields)
+    for link in links:
+        table = bypk[link.table_id]
+        link._table_cache = table
+        table._links.append(link)
+        if link.related_id in related:
+            link._related_cache = related[link.related_id]
+    def depth(table):
+        level = 0
+        while table.parent_id in bypk:
+            table, level = bypk[table.parent_id], level + 1
+        return level
+    return sorted(tables, key=lambda x: (depth(x), x.pk))
+
+
+def schema_factory(version=None):
+    """Lee el esquema completo con un numero fijo de consultas.
+
+    El parametro "version" se ignora, el esquema se lee siempre de la
+    base de datos. Devuelve todas las instancias de Table, precargadas
+    con sus campos y enlaces (ver "preload"), en orden topologico.
+    """
+    tables = list(Table.objects.all())
+    fields = list(Field.objects.order_by('pk'))
+    links = list(Link.objects.order_by('pk'))
+    return preload(tables, fields, links)
\ No newline at end of file
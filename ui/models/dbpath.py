@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Resolucion de la ruta de identidades de un conjunto de filas
+
+Para mostrar de que objeto cuelga cada fila (o para construir la consulta
+que lleva hasta el), hace falta el campo de identidad de cada uno de sus
+ancestros. En lugar de subir con .up nivel a nivel para cada fila, se leen
+todos con una unica consulta values_list a traves de la cadena de claves
+_up__..._up, que solo trae esas columnas.
+"""
+
+
+def _lookup(depth, name):
+    """Lookup que alcanza el campo "name" del ancestro a "depth" niveles"""
+    return '__'.join(('_up',) * depth + (name,))
+
+
+def resolve_paths(model, pks, identities):
+    """Devuelve un diccionario pk -> tupla de identidades
+
+    "identities" son los atributos de identidad de cada nivel, alineados
+    con model._DOMD.path desde la raiz (puede ser mas corta, y los niveles
+    a None se omiten y valen None en el resultado).
+
+    Los campos calculados que no estan materializados no tienen columna;
+    para ellos se lee la pk del ancestro en la misma consulta, y luego
+    cada ancestro distinto una sola vez. Lo mismo se hace con los
+    materializados cuya columna aun no se ha rellenado (vale NULL).
+    """
+    path = model._DOMD.path
+    lookups = list()
+    for index, attrib in enumerate(identities):
+        if attrib is None:
+            continue
+        depth, domd = len(path) - 1 - index, path[index]._DOMD
+        # pk del ancestro: la clave _up del nivel inferior
+        ancestor = _lookup(depth - 1, '_up') if depth else 'pk'
+        if attrib == 'pk':
+            # la identidad por defecto es la propia pk del ancestro
+            column, ancestor = ancestor, None
+        elif attrib in domd.dynamics:
+            column = domd.columns.get(attrib)
+            if column is not None:
+                column = _lookup(depth, column)
+        elif attrib in domd.attribs:
+            column, ancestor = _lookup(depth, attrib), None
+        else:
+            column = None
+        lookups.append((index, column, ancestor))
+    if not pks:
+        return dict()
+    names = ['pk']
+    for index, column, ancestor in lookups:
+        names.extend(x for x in (column, ancestor) if x is not None)
+    rows = model._DOMD.objects.filter(pk__in=tuple(pks)).values_list(*names)
+    cache, result = dict(), dict()
+    for row in rows:
+        values, fields = [None] * len(identities), iter(row[1:])
+        for index, column, ancestor in lookups:
+            value = fields.next() if column is not None else None
+            parent = fields.next() if ancestor is not None else None
+            if value is None and parent is not None:
+                key = (index, parent)
+                if key not in cache:
+                    instance = path[index]._DOMD.objects.get(pk=parent)
+                    cache[key] = getattr(instance, identities[index], None)
+                value = cache[key]
+            values[index] = value
+        result[row[0]] = tuple(values)
+    return result
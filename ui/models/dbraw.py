@@ -9,6 +9,7 @@ real la base de datos, agregando, alterando y borrando tablas y campos.
 """
 
 from copy import copy
+import re
 
 from django.db import models, connection
 from django.core.management import sql, color
@@ -136,6 +137,31 @@ def sql_update_null(model, name, field, defval):
     return [("UPDATE %s SET %s=%%s WHERE %s IS NULL" % (table, name, name), clean)]
 
 
+def sql_touch(model):
+    """Genera una sentencia SQL que no modifica nada, pero que se registra
+    en el ChangeLog como un cambio de la tabla"""
+    table, pk = model._meta.db_table, model._meta.pk.column
+    return ["UPDATE %s SET %s=%s WHERE 1=0" % (table, pk, pk)]
+
+
+# Sentencias SQL que modifican una tabla generada. El nombre de la tabla
+# termina en la pk de la instancia de Table que la define.
+TABLE_STATEMENT = re.compile(r'''^\s*(?:(?:CREATE|ALTER|DROP)\s+TABLE'''
+                             r'''(?:\s+IF\s+EXISTS)?|UPDATE)\s+[`"]?'''
+                             r'''(\w+)_(\d+)[`"]?(?:[\s;(]|$)''', re.I)
+
+
+def sql_table_pk(sql):
+    """Devuelve la pk de la tabla a la que afecta una sentencia SQL
+
+    Si la sentencia no afecta a una tabla generada, devuelve None.
+    """
+    match = TABLE_STATEMENT.match(sql)
+    if not match or not match.group(1).startswith('%s_' % Cache.app_label):
+        return None
+    return int(match.group(2))
+
+
 def execute(query_list):
     """Ejecuta una serie de consultas SQL.
     Cada consulta puede ser bien un texto, o bien una tupla(sql, parametros).
@@ -237,8 +263,11 @@ def post_save_table(old_instance, old_model, cur_instance):
 
 def delete_field(table, field):
     """Borra un campo de una tabla"""
+    statements = sql_drop_field(Cache[table], field._name)
+    if getattr(field, 'materialized', False):
+        statements.extend(sql_drop_field(Cache[table], field._matname))
     try:
-        execute(sql_drop_field(Cache[table], field._name))
+        execute(statements)
     except Exception:
         pass
 
@@ -278,6 +307,13 @@ def update_field(table, old_instance, current_instance):
             statements.extend(sql_update_null(model, name, field,
                                               new.default))
         statements.extend(sql_modify_field(model, name, field))
+        # la columna materializada sigue al campo
+        if getattr(new, 'materialized', False):
+            old_mat, matfield = old._matname, new.matfield
+            if old_mat != new._matname:
+                statements.extend(sql_rename_field(model, old_mat,
+                                  new._matname, matfield))
+            statements.extend(sql_modify_field(model, new._matname, matfield))
     # si el campo ha adquirido un indice, lo indexo
     if not old or old.index != new.index:
         # usar un nombre de indice no ligado al nombre del campo permite
@@ -303,3 +339,41 @@ def update_dynamic(field, dynamic, save=True):
         old_name, new_name = dynamic.name, field.name
     execute(sql_rename_field(Cache[field.table], old_name,
                              new_name, field.field))
+
+
+def update_code(field):
+    """Registra un cambio en el codigo de un campo dinamico.
+
+    El cambio no modifica la tabla, pero si el modelo. Se guarda como
+    un ChangeLog para que cambie la version del esquema, y el resto de
+    procesos (y las copias en disco, ver dbsnapshot) lo tengan en cuenta.
+    """
+    execute(sql_touch(Cache[field.table]))
+
+
+def update_materialized(field, save=True):
+    """Crea o elimina la columna con el valor materializado de un campo.
+
+    Si save == True, crea la columna y la rellena con el valor actual.
+    Si save == False, la elimina.
+    """
+    model = Cache[field.table]
+    if save:
+        statements = sql_add_field(model, field._matname, field.matfield)
+    else:
+        statements = sql_drop_field(model, field._matname)
+    execute(statements)
+    if save:
+        refresh_materialized(field)
+
+
+def refresh_materialized(field):
+    """Rellena la columna materializada de un campo con su valor actual.
+
+    Los filtros SQL usan la columna en cuanto existe, asi que no se
+    puede esperar al thread de refresco. Se reconstruye antes el modelo,
+    para que tenga la columna y el codigo del campo dinamico ya guardado.
+    """
+    from .dbrefresh import refresh_field
+    Cache.invalidate(field.table)
+    refresh_field(Cache[field.table], field.name, field._matname)
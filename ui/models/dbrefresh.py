@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Refresco de campos dinamicos materializados
+
+Los campos dinamicos marcados como "materialized" guardan su valor
+calculado en una columna adicional de la tabla generada (ver
+Field._matname), de forma que se pueda filtrar por ellos en SQL. Este
+modulo recalcula esas columnas.
+
+Al crear la columna, o al cambiar el codigo del campo, se rellena en el
+momento (ver dbraw.refresh_materialized). Despues, el refresco lo hace
+un thread de fondo, que no se arranca solo: hay que invocar start, o
+usar la orden "manage.py refresh_materialized". Al arrancar, o cuando
+cambia el esquema, recalcula todas las columnas y construye el indice de
+dependencias (ver dbdeps). A partir de ahi, solo recalcula los campos y
+filas afectados por cada cambio:
+
+    - Los cambios hechos en este proceso se notifican con precision de
+      fila (ver dbbase.data_listeners).
+    - Los hechos en otros procesos se detectan cada MATERIALIZED_POLL
+      segundos comparando las versiones de los datos de las tablas, y
+      se tratan como cambios en la tabla completa.
+
+Si MATERIALIZED_REFRESH no es None, se hace ademas un refresco completo
+cada ese numero de segundos. Si hay varios procesos, solo refresca el
+que tiene la concesion publicada en el canal de versiones.
+"""
+
+import os
+import time
+import logging
+from threading import Thread, Lock, Event, currentThread
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .dblog import after_commit
+from .dbcache import Cache, VARIABLES_TABLE, VARIABLES_KEY
+from .dbbase import bump_data, data_listeners
+from .dbversion import versions, data_key
+from .dbdeps import Recording, dependencies
+from .dbstats import stats
+
+
+# Clave del canal de versiones con la concesion del refresco
+REFRESH_KEY = 'materialized.refresh'
+
+# Numero de filas que se actualizan en cada sentencia
+REFRESH_CHUNK = 500
+
+log = logging.getLogger(__name__)
+
+
+def materialized_fields():
+    """Devuelve una lista de tuplas (modelo, nombre, columna)"""
+    from .dbmodel import Field
+    fields = Field.objects.select_related('table').all()
+    return list((Cache[x.table], x.name, x._matname)
+                for x in fields if x.code is not None and x.materialized)
+
+
+def refresh_field(model, name, column, pks=None):
+    """Recalcula la columna materializada de un campo dinamico.
+
+    Si se indica "pks", solo se recalculan esas filas. Solo se actualizan
+    las filas cuyo valor haya cambiado. Devuelve el numero de filas
+    actualizadas.
+    """
+    field = model._meta.get_field(column)
+    objects = model._DOMD.objects.all()
+    if pks is not None:
+        objects = objects.filter(pk__in=tuple(pks))
+    changed = list()
+    with Recording():
+        for item in objects:
+            value = getattr(item, name)
+            if value != getattr(item, column):
+                changed.append((field.get_db_prep_save(value), item.pk))
+    if not changed:
+        return 0
+    qn = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+              qn(model._meta.db_table), qn(column), qn(model._meta.pk.column))
+    cursor = connection.cursor()
+    for index in xrange(0, len(changed), REFRESH_CHUNK):
+        cursor.executemany(sql, changed[index:index+REFRESH_CHUNK])
+    transaction.commit_unless_managed()
+    # dentro de una transaccion (por ejemplo, al salvar un campo dinamico)
+    # la version de los datos se publica tras el commit, para que nadie
+    # guarde en cache los valores antiguos con la version nueva.
+    after_commit(bump_data, model)
+    return len(changed)
+
+
+def refresh(fields=None):
+    """Recalcula las columnas materializadas indicadas, o todas"""
+    if fields is None:
+        fields = materialized_fields()
+    total = 0
+    for model, name, column in fields:
+        with stats.timer('refresh.%s.%s' % (model._DOMD.fullname, name)):
+            total += refresh_field(model, name, column)
+    stats.incr('refresh.rows', total)
+    return total
+
+
+def refresh_targets(fields, rows):
+    """Recalcula los campos completos y las filas indicadas.
+
+    "fields" es un conjunto de tuplas (modelo, campo), y "rows" un conjunto
+    de tuplas (modelo, campo, fila), como las que devuelve
+    dbdeps.Dependencies.changed.
+    """
+    partial = dict()
+    for target in rows:
+        if target[:2] not in fields:
+            partial.setdefault(target[:2], set()).add(target[2])
+    total = 0
+    for (pk, name) in set(fields).union(partial):
+        model = Cache.get(pk)
+        column = model._DOMD.columns.get(name) if model else None
+        if column is None:
+            continue
+        total += refresh_field(model, name, column, partial.get((pk, name)))
+    stats.incr('refresh.targeted', total)
+    return total
+
+
+class Refresher(Thread):
+
+    """Thread que mantiene actualizados los campos materializados"""
+
+    def __init__(self, poll, interval=None):
+        super(Refresher, self).__init__(name='materialized-refresh')
+        self.setDaemon(True)
+        self.poll = poll
+        self.interval = interval
+        self.owner = '%d.%d' % (os.getpid(), id(self))
+        self.event = Event()
+        self.lock = Lock()
+        self.generation = None
+        self.last = 0
+        self.fields = set()
+        self.rows = set()
+        self.known = dict()
+
+    def leader(self):
+        """Renueva la concesion, o comprueba si ha caducado"""
+        now = time.time()
+        try:
+            owner, stamp = versions.peek(REFRESH_KEY).rsplit(':', 1)
+            stamp = float(stamp)
+        except (AttributeError, TypeError, ValueError):
+            owner, stamp = None, 0
+        if owner != self.owner and now - stamp < 3 * self.poll:
+            return False
+        versions.publish(REFRESH_KEY, '%s:%r' % (self.owner, now))
+        return True
+
+    def schedule(self, fields, rows, table=None, version=None):
+        """Agrega objetivos pendientes de refrescar"""
+        with self.lock:
+            self.fields.update(fields)
+            self.rows.update(rows)
+            if table is not None:
+                self.known[table] = version
+        self.event.set()
+
+    def changed(self, model, version, instance):
+        """Recibe los cambios hechos en este proceso (data_listeners)"""
+        domd, row, variable = model._DOMD, None, None
+        if currentThread() is self:
+            # cambios del propio refresco: solo cambian las columnas
+            # materializadas, que solo afectan a los campos que consultan
+            # la tabla (no a los que leen filas concretas).
+            self.schedule(dependencies.readers(domd.pk), (), domd.pk, version)
+            return
+        if instance is not None:
+            row = instance.pk
+            if domd.name == VARIABLES_TABLE and domd.parent._DOMD.pk is None:
+                variable = unicode(getattr(instance, VARIABLES_KEY)).lower()
+        fields, rows = dependencies.changed(domd.pk, row, variable)
+        if row is not None:
+            # los campos materializados de la propia fila
+            rows.update((domd.pk, x, row) for x in domd.columns)
+        self.schedule(fields, rows, domd.pk, version)
+
+    def full(self):
+        """Refresco completo, que reconstruye el indice de dependencias"""
+        dependencies.clear()
+        refresh()
+        tables = dependencies.known()
+        current = versions.get_many(data_key(x) for x in tables)
+        with self.lock:
+            self.known = dict((x, current[data_key(x)]) for x in tables)
+
+    def remote(self):
+        """Objetivos afectados por cambios hechos en otros procesos"""
+        tables = dependencies.known()
+        current = versions.get_many(data_key(x) for x in tables)
+        fields, rows = set(), set()
+        with self.lock:
+            for table in tables:
+                version = current[data_key(table)]
+                if self.known.get(table) != version:
+                    self.known[table] = version
+                    fields.update(dependencies.changed(table)[0])
+        return fields, rows
+
+    def step(self):
+        generation = Cache.current
+        if (generation is not self.generation or
+            (self.interval and time.time() - self.last > self.interval)):
+            self.generation, self.last = generation, time.time()
+            with self.lock:
+                self.fields, self.rows = set(), set()
+            self.full()
+            return
+        fields, rows = self.remote()
+        with self.lock:
+            fields.update(self.fields)
+            rows.update(self.rows)
+            self.fields, self.rows = set(), set()
+        if fields or rows:
+            refresh_targets(fields, rows)
+
+    def run(self):
+        while True:
+            self.event.wait(self.poll)
+            self.event.clear()
+            if not self.leader():
+                # los cambios locales los vera el otro proceso a traves
+                # de las versiones de las tablas.
+                with self.lock:
+                    self.fields, self.rows = set(), set()
+                continue
+            Cache.pin()
+            try:
+                Cache.data.refresh()
+                self.step()
+            except Exception:
+                stats.incr('refresh.errors')
+                log.exception('error refrescando los campos materializados')
+            finally:
+                Cache.release()
+                connection.close()
+
+
+_refresher = None
+_refresher_lock = Lock()
+
+
+def _changed(model, version, instance):
+    if _refresher is not None:
+        _refresher.changed(model, version, instance)
+
+data_listeners.append(_changed)
+
+
+def start(poll=None, interval=None):
+    """Arranca el thread de refresco, si no estaba ya arrancado
+
+    Por defecto, "poll" e "interval" se toman de MATERIALIZED_POLL y
+    MATERIALIZED_REFRESH. Si "poll" es None, no se arranca.
+    """
+    global _refresher
+    if poll is None:
+        poll = getattr(settings, 'MATERIALIZED_POLL', None)
+        interval = getattr(settings, 'MATERIALIZED_REFRESH', None)
+    with _refresher_lock:
+        if _refresher is None and poll:
+            _refresher = Refresher(poll, interval)
+            _refresher.start()
+    return _refresher
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Cache de resultados de consultas
+
+Guarda en la cache compartida (ver dbshared) las filas que devuelve una
+consulta, junto con la version de los datos (ver dbversion.data_key) de
+cada tabla que interviene en ella. Al leer un resultado de la cache se
+comparan esas versiones con las actuales, y si alguna ha cambiado el
+resultado se descarta.
+
+La cache compartida agrega a las claves la version del esquema, de forma
+que un cambio en el esquema invalida todos los resultados. Solo se guardan
+resultados de hasta RESULT_CACHE_MAX_ROWS filas; el resto del limite de
+tamano lo pone el propio backend de la cache compartida.
+"""
+
+import re
+
+from django.conf import settings
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from .dbcache import Cache
+from .dbbase import QueryItem, AndQuery
+from .dbversion import versions, data_key
+from .dbdeps import Tracker
+from .dbtemp import subqueries
+from .dbshared import shared
+from .dbstats import stats
+
+
+def model_chain(model):
+    """Devuelve el modelo y sus ancestros, del mas cercano al raiz"""
+    return [model] + list(reversed(model._DOMD.parents))
+
+
+def dump_row(instance, models):
+    """Convierte una fila (y sus ancestros precargados) en tuplas"""
+    rows = list()
+    for model in models:
+        rows.append(tuple(getattr(instance, x.attname)
+                          for x in model._meta.fields))
+        if len(rows) == len(models):
+            break
+        cache_name = model._meta.get_field('_up').get_cache_name()
+        instance = instance.__dict__.get(cache_name)
+        if instance is None:
+            break
+    return tuple(rows)
+
+
+def load_row(rows, models):
+    """Inversa de dump_row"""
+    first, child = None, None
+    for values, model in zip(rows, models):
+        instance = model(*values)
+        if child is not None:
+            cache_name = child._meta.get_field('_up').get_cache_name()
+            setattr(child, cache_name, instance)
+        first, child = first or instance, instance
+    return first
+
+
+class ResultCache(object):
+
+    """Cache de resultados de consultas, validada con versiones de datos"""
+
+    def __init__(self, maxrows=None, timeout=None):
+        if maxrows is None:
+            maxrows = getattr(settings, 'RESULT_CACHE_MAX_ROWS', 1000)
+        if timeout is None:
+            timeout = getattr(settings, 'RESULT_CACHE_TIMEOUT', 300)
+        self.maxrows = maxrows
+        self.timeout = timeout
+        self.table = re.compile(r'\b%s_\w+_(\d+)\b' % Cache.app_label)
+
+    def tables(self, items):
+        """Devuelve las pks de las tablas que aparecen en la consulta SQL"""
+        try:
+            sql, params = items.query.as_sql()
+        except EmptyResultSet:
+            # la consulta no llega a ejecutarse (por ejemplo, "IN ()"):
+            # se toma como dependiente solo de las tablas del modelo.
+            return set(x._DOMD.pk for x in model_chain(items._type)
+                       if x._DOMD.pk is not None)
+        tables = set(int(x) for x in self.table.findall(sql))
+        # las subconsultas volcadas a tablas temporales no aparecen
+        # en el SQL de la consulta exterior.
+        for queryset in subqueries(items.query.where):
+            tables.update(self.tables(queryset))
+        return tables
+
+    def get(self, q):
+        """Devuelve el resultado guardado, o None si no es valido"""
+        entry = shared.get('results', q)
+        if entry is None:
+            return None
+        query, model_pk, saved, rows = entry
+        if query != q:
+            return None
+        current = versions.get_many(saved.keys())
+        if any(current[x] != y for x, y in saved.iteritems()):
+            stats.incr('results.stale')
+            return None
+        model = Cache.get(model_pk) or Cache(model_pk)
+        models = model_chain(model)
+        rows = list(load_row(x, models) for x in rows)
+        crit = QueryItem(True, 'pk__in', tuple(x.pk for x in rows), False)
+        items = model._DOMD.objects.filter(crit.q()).all()
+        items._crit = AndQuery(crit)
+        items._result_cache = rows
+        items._versions = saved
+        return items
+
+    def set(self, q, items, saved):
+        """Guarda el resultado (ya evaluado) de una consulta"""
+        rows = items._result_cache
+        if rows is None or len(rows) > self.maxrows:
+            return
+        models = model_chain(items._type)
+        rows = tuple(dump_row(x, models) for x in rows)
+        entry = (q, items._type._DOMD.pk, saved, rows)
+        shared.set('results', q, entry, self.timeout)
+
+    def query(self, q):
+        """Evalua una consulta, usando la cache si el resultado es valido"""
+        items = self.get(q)
+        if items is not None:
+            stats.incr('results.hits')
+            return items
+        stats.incr('results.misses')
+        with Tracker() as deps:
+            items = Cache.query(q)
+        if not hasattr(items, 'query') or not hasattr(items, '_type'):
+            return items
+        # las versiones se leen antes de ejecutar la consulta, para que
+        # un cambio concurrente invalide el resultado en lugar de quedar
+        # oculto.
+        tables = self.tables(items)
+        tables.update(x[0] for x in deps.variables)
+        tables.update(deps.tables)
+        tables.update(x[0] for x in deps.rows)
+        saved = versions.get_many(data_key(x) for x in tables)
+        # solo se evaluan aqui los resultados que caben en la cache; los
+        # mayores se dejan sin evaluar, para que la vista pueda paginarlos
+        # o contarlos en SQL. Para saberlo, basta con leer las pks.
+        probe = items.values_list('pk', flat=True)[:self.maxrows+1]
+        if len(probe) <= self.maxrows:
+            items._result_cache = list(items)
+            self.set(q, items, saved)
+        items._versions = saved
+        return items
+
+
+results = ResultCache()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Cache compartida entre procesos
+
+Nivel de cache para datos que interesa compartir entre todos los workers
+(definiciones de vistas, resultados de consultas, fragmentos de html ya
+generados...), con un backend intercambiable:
+
+    - DjangoTier: usa el backend de cache de django (CACHE_BACKEND). Solo
+      se comparte entre procesos si el backend lo hace (memcached...).
+    - FileTier: guarda cada entrada en un fichero de un directorio local,
+      y elimina las entradas usadas hace mas tiempo cuando el tamano
+      total supera SHARED_CACHE_MAX_BYTES.
+
+El backend se selecciona con el setting SHARED_CACHE_BACKEND ('django',
+'file' o la ruta completa a una clase), y el directorio del FileTier con
+el setting SHARED_CACHE_DIR.
+
+Las claves se agrupan en espacios de nombres, y se les agrega la version
+del esquema, de forma que un cambio de esquema deja obsoletas todas las
+entradas.
+"""
+
+import os
+import time
+import tempfile
+import cPickle as pickle
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .dbcache import Cache
+from .dbstats import stats
+
+
+SHARED_PREFIX = 'plantiweb.shared.'
+
+
+class DjangoTier(object):
+
+    """Entradas almacenadas en el backend de cache de django"""
+
+    def get(self, key):
+        return cache.get(SHARED_PREFIX + key)
+
+    def set(self, key, value, timeout):
+        cache.set(SHARED_PREFIX + key, value, timeout)
+
+    def delete(self, key):
+        cache.delete(SHARED_PREFIX + key)
+
+
+class FileTier(object):
+
+    """Entradas almacenadas en ficheros de un directorio local
+
+    Cada entrada se guarda en un fichero, junto con su fecha de caducidad.
+    Al leer una entrada se actualiza la fecha de modificacion del fichero,
+    que es la que se usa para descartar las menos usadas.
+    """
+
+    def __init__(self, path=None, maxbytes=None):
+        if path is None:
+            path = getattr(settings, 'SHARED_CACHE_DIR', None)
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'plantiweb-shared')
+        if maxbytes is None:
+            maxbytes = getattr(settings, 'SHARED_CACHE_MAX_BYTES', 64 << 20)
+        self.path = path
+        self.maxbytes = maxbytes
+        self.size = None
+        self.lock = Lock()
+
+    def _filename(self, key):
+        return os.path.join(self.path, md5(key).hexdigest() + '.entry')
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            entry = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                saved, expires, value = pickle.load(entry)
+            except Exception:
+                return None
+        finally:
+            entry.close()
+        if saved != key or expires < time.time():
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value, timeout):
+        data = pickle.dumps((key, time.time() + timeout, value),
+                            pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxbytes:
+            return
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        fd, tmpname = tempfile.mkstemp(dir=self.path)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        filename = self._filename(key)
+        try:
+            os.rename(tmpname, filename)
+        except OSError:
+            # en windows, rename no sobreescribe el fichero destino
+            try:
+                os.remove(filename)
+                os.rename(tmpname, filename)
+            except OSError:
+                os.remove(tmpname)
+                return
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data)
+            if self.size is None or self.size > self.maxbytes:
+                self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Elimina las entradas mas antiguas hasta bajar del limite
+
+        El tamano se recalcula leyendo el directorio, porque otros
+        procesos tambien escriben en el.
+        """
+        entries = list()
+        for name in os.listdir(self.path):
+            if not name.endswith('.entry'):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                info = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, filename))
+        size = sum(x[1] for x in entries)
+        if size > self.maxbytes:
+            # dejo algo de margen para no desalojar en cada escritura
+            limit = self.maxbytes * 0.9
+            for mtime, length, filename in sorted(entries):
+                if size <= limit:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                size -= length
+                stats.incr('shared.evictions')
+        self.size = size
+
+
+TIERS = {
+    'django': DjangoTier,
+    'file': FileTier,
+}
+
+
+def get_tier(name=None):
+    """Construye el backend indicado por nombre o ruta a la clase"""
+    if name is None:
+        name = getattr(settings, 'SHARED_CACHE_BACKEND', 'django')
+    try:
+        tier = TIERS[name]
+    except KeyError:
+        module, attr = name.rsplit('.', 1)
+        tier = getattr(__import__(module, {}, {}, [attr]), attr)
+    return tier()
+
+
+class SharedCache(object):
+
+    """Cache compartida, con espacios de nombres por version de esquema"""
+
+    def __init__(self, tier=None, timeout=None):
+        self._tier = tier
+        if timeout is None:
+            timeout = getattr(settings, 'SHARED_CACHE_TIMEOUT', 300)
+        self.timeout = timeout
+
+    @property
+    def tier(self):
+        if self._tier is None:
+            self._tier = get_tier()
+        return self._tier
+
+    def key(self, namespace, key):
+        """Construye la clave completa (espacio, esquema, clave)"""
+        key = u'%s.%s.%s' % (namespace, Cache.current.version, key)
+        return md5(key.encode('utf-8')).hexdigest()
+
+    def get(self, namespace, key):
+        value = self.tier.get(self.key(namespace, key))
+        stats.incr('shared.%s.%s' % (namespace,
+                   'misses' if value is None else 'hits'))
+        return value
+
+    def set(self, namespace, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        self.tier.set(self.key(namespace, key), value, timeout)
+
+    def delete(self, namespace, key):
+        self.tier.delete(self.key(namespace, key))
+
+
+shared = SharedCache()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Copia en disco del esquema
+
+Guarda en un fichero local la descripcion del esquema (tablas, campos y
+enlaces) correspondiente a una version, junto con el codigo compilado de
+los campos dinamicos. Los procesos que arrancan con la misma version de
+esquema cargan la copia, en lugar de consultar las metatablas y compilar
+de nuevo el codigo.
+
+La version es la del ultimo ChangeLog. Los cambios en el codigo de los
+campos dinamicos, que no alteran ninguna tabla, tambien generan uno (ver
+dbraw.update_code), asi que nunca se carga codigo compilado antiguo.
+
+El directorio donde se guardan las copias se indica con el setting
+SCHEMA_SNAPSHOT_DIR. Si no esta definido, no se usan copias.
+"""
+
+import os
+import re
+import imp
+import marshal
+import tempfile
+
+from django.conf import settings
+
+from .dbmodel import Table, Field, Link, preload, schema_factory
+from .dbmeta import compile_code
+
+
+TABLE_ATTRS = ('id', 'parent_id', 'name', 'comment')
+FIELD_ATTRS = ('id', 'table_id', 'name', 'kind', 'len',
+               'null', 'index', 'comment')
+LINK_ATTRS  = ('id', 'table_id', 'basename', 'group', 'related_id',
+               'null', 'index', 'comment')
+
+SNAPSHOT_NAME = re.compile(r'^schema-(\d+)\.snapshot$')
+
+# El formato de marshal depende de la version de python
+MAGIC = imp.get_magic()
+
+
+def snapshot_path(version):
+    """Ruta del fichero de la version indicada, o None si no hay copias"""
+    path = getattr(settings, 'SCHEMA_SNAPSHOT_DIR', None)
+    if path is None or version is None:
+        return None
+    return os.path.join(path, 'schema-%s.snapshot' % version)
+
+
+def dump(path, version, tables):
+    """Guarda en disco las tablas precargadas (ver dbmodel.preload)"""
+    fields, links = list(), list()
+    for table in tables:
+        for field in table._fields:
+            code = field.code
+            if code is not None:
+                code = (code, compile_code(field, table.fullname),
+                        field.materialized)
+            values = tuple(getattr(field, x) for x in FIELD_ATTRS)
+            fields.append((values, code))
+        for link in table._links:
+            links.append(tuple(getattr(link, x) for x in LINK_ATTRS))
+    tables = tuple(tuple(getattr(x, y) for y in TABLE_ATTRS) for x in tables)
+    data = marshal.dumps((MAGIC, version, tables, tuple(fields), tuple(links)))
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    # escribo en un temporal y renombro, para que ningun otro proceso
+    # lea un fichero a medio escribir.
+    fd, tmpname = tempfile.mkstemp(dir=dirname)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    try:
+        os.rename(tmpname, path)
+    except OSError:
+        os.remove(tmpname)
+        raise
+
+
+def load(path, version):
+    """Carga las tablas guardadas en disco.
+
+    Devuelve las tablas precargadas y en orden topologico, igual que
+    dbmodel.schema_factory. Si el fichero no corresponde a la version
+    indicada, lanza ValueError.
+    """
+    snapshot = open(path, 'rb')
+    try:
+        magic, saved, tables, fields, links = marshal.load(snapshot)
+    finally:
+        snapshot.close()
+    if magic != MAGIC or saved != version:
+        raise ValueError(path)
+    tables = list(Table(**dict(zip(TABLE_ATTRS, x))) for x in tables)
+    loaded = list()
+    for values, code in fields:
+        field = Field(**dict(zip(FIELD_ATTRS, values)))
+        field._code, field._materialized = None, False
+        if code is not None:
+            field._code, field._compiled, field._materialized = code
+        loaded.append(field)
+    links = list(Link(**dict(zip(LINK_ATTRS, x))) for x in links)
+    return preload(tables, loaded, links)
+
+
+def purge(path, version):
+    """Elimina las copias de versiones anteriores a la indicada"""
+    for name in os.listdir(path):
+        match = SNAPSHOT_NAME.match(name)
+        if match and int(match.group(1)) < version:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def snapshot_factory(version=None):
+    """Lee el esquema de disco, o de la base de datos si no hay copia.
+
+    Cumple el mismo contrato que dbmodel.schema_factory. Si el esquema
+    se lee de la base de datos, se guarda una copia para la version dada.
+    """
+    path = snapshot_path(version)
+    if path is None:
+        return schema_factory(version)
+    try:
+        return load(path, version)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    tables = schema_factory(version)
+    try:
+        dump(path, version, tables)
+        purge(os.path.dirname(path), version)
+    except (IOError, OSError, ValueError, SyntaxError):
+        # no poder guardar la copia no impide seguir trabajando
+        pass
+    return tables
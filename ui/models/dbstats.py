@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Contadores e histogramas de tiempos
+
+Estadisticas internas de la cache de modelos (aciertos, fallos, tiempos
+de construccion, invalidaciones...), accesibles mediante Stats.snapshot.
+Los contadores son por proceso.
+"""
+
+import time
+from threading import Lock
+
+
+# Limites superiores (en milisegundos) de los intervalos de los histogramas
+BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class Histogram(object):
+
+    """Histograma de tiempos"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, millis):
+        self.count += 1
+        self.total += millis
+        self.max = max(self.max, millis)
+        for index, limit in enumerate(BUCKETS):
+            if millis <= limit:
+                break
+        else:
+            index = len(BUCKETS)
+        self.buckets[index] += 1
+
+    def snapshot(self):
+        limits = BUCKETS + (None,)
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'max_ms': round(self.max, 3),
+            'buckets': list((x, y) for x, y in zip(limits, self.buckets) if y),
+        }
+
+
+class Timer(object):
+
+    """Mide el tiempo que tarda un bloque "with" y lo agrega a Stats"""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.time(self.name, time.time() - self.start)
+
+
+class Stats(object):
+
+    """Contadores e histogramas de tiempos, con nombre"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.timings = dict()
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def time(self, name, seconds):
+        with self.lock:
+            try:
+                histogram = self.timings[name]
+            except KeyError:
+                histogram = self.timings.setdefault(name, Histogram())
+            histogram.add(seconds * 1000.0)
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def snapshot(self):
+        """Devuelve una copia de los contadores y tiempos"""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': dict((x, y.snapshot())
+                                for x, y in self.timings.iteritems()),
+            }
+
+
+stats = Stats()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Subconsultas de pertenencia materializadas en tablas temporales
+
+Los filtros del tipo "campo + otra_tabla.atributo" se traducen en
+condiciones "campo IN (SELECT atributo FROM ...)". MySQL 5.x las ejecuta
+como subconsultas correlacionadas, que se repiten para cada fila de la
+tabla exterior.
+
+En su lugar, el conjunto interior se vuelca una sola vez a una tabla
+temporal (CREATE TEMPORARY TABLE ... SELECT DISTINCT) con clave primaria
+en el valor, y:
+
+    - Si la condicion esta en el nivel superior de la consulta (unida con
+      AND al resto), se reescribe como un INNER JOIN con la tabla
+      temporal (semi-join), o como un LEFT JOIN ... IS NULL si esta
+      negada (anti-join). Ver semijoin.
+    - En otro caso (dentro de un OR, de un NOT compuesto o de una
+      subconsulta), se queda como "campo IN (SELECT v FROM temporal)",
+      que MySQL resuelve con una busqueda en la clave primaria.
+
+Las tablas temporales solo se crean al ejecutar la consulta (ver
+TempQuery.execute_sql), nunca al compilarla sin mas (por ejemplo, para
+obtener su SQL), y se eliminan en cuanto termina la sentencia. Asi no se
+acumulan en las conexiones de larga duracion, como la del thread de
+refresco. Los resultados de MySQLdb se leen enteros al ejecutar, asi que
+la tabla se puede eliminar aunque aun no se hayan recorrido.
+
+Lo mismo se hace con las listas literales de al menos THRESHOLD valores
+(por ejemplo, cientos de nombres pegados en la consulta de la pagina de
+inicio), que se cargan en bloque en la tabla temporal en lugar de generar
+un "IN (...)" enorme.
+
+MySQL no permite usar la misma tabla temporal dos veces en una sentencia
+(error 1137, "Can't reopen table"). Cada sentencia que se ejecuta abre un
+ambito (ver Statement) que registra los conjuntos ya usados, y las
+repeticiones se sustituyen por la subconsulta o lista original.
+
+Los valores NULL del conjunto interior se descartan. Fuera de MySQL, o si
+no se puede crear la tabla temporal, se usa la subconsulta o lista
+original.
+"""
+
+from itertools import count
+from threading import Lock, local
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+from django.db.models.sql import Query
+from django.db.models.sql.where import AND
+from django.utils.tree import Node
+
+from .dbstats import stats
+
+
+# Numero minimo de elementos para volcar una lista literal a una tabla
+# temporal (ver literal). None para no hacerlo nunca.
+THRESHOLD = 500
+
+# Numero de filas que se insertan en cada sentencia
+CHUNK = 1000
+
+_names = count(1)
+_names_lock = Lock()
+_local = local()
+
+
+def supported():
+    """Indica si la base de datos admite la reescritura"""
+    return settings.DATABASE_ENGINE == 'mysql'
+
+
+class Statement(object):
+
+    """Ambito de ejecucion de una sentencia SQL
+
+    Se usa como contexto de un bloque "with". Guarda los conjuntos de
+    valores que ya aparecen en la sentencia, y las tablas temporales
+    creadas para ella, que se eliminan al salir del bloque.
+    """
+
+    def __init__(self):
+        self.used = set()
+        self.created = list()
+
+    def __enter__(self):
+        self.saved = getattr(_local, 'statement', None)
+        _local.statement = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.statement = self.saved
+        if self.created:
+            drop(self.created)
+
+
+def statement():
+    """Devuelve el ambito de la sentencia en ejecucion, o None"""
+    return getattr(_local, 'statement', None)
+
+
+def drop(tables):
+    """Elimina las tablas temporales indicadas"""
+    qn = connection.ops.quote_name
+    try:
+        connection.cursor().execute('DROP TEMPORARY TABLE IF EXISTS %s' %
+                                    ', '.join(qn(x) for x in tables))
+    except DatabaseError:
+        # se eliminaran al cerrar la conexion
+        stats.incr('temp.errors')
+    else:
+        stats.incr('temp.drops', len(tables))
+
+
+class TempQuery(Query):
+
+    """Query que abre un ambito de sentencia al ejecutarse
+
+    La consulta (y sus subconsultas) se compila dentro del ambito, que
+    es el que crea y elimina las tablas temporales. Antes de compilarla,
+    las condiciones de pertenencia del nivel superior se reescriben como
+    joins (ver semijoin).
+    """
+
+    def execute_sql(self, *arg, **kw):
+        if not supported():
+            return super(TempQuery, self).execute_sql(*arg, **kw)
+        with Statement():
+            query = semijoin(self)
+            return super(TempQuery, query).execute_sql(*arg, **kw)
+
+
+class TempValues(object):
+
+    """Conjunto de valores volcado a una tabla temporal
+
+    Se usa como valor de un lookup "__in". Django lo trata como una
+    expresion SQL (tiene as_sql y relabel_aliases), y no lo evalua hasta
+    que se compila la consulta. Las subclases implementan "fill", que
+    crea y llena la tabla, y "fallback", que devuelve el SQL a usar si
+    no se ha podido crear.
+
+    El objeto no guarda estado (la tabla es de la sentencia), asi que se
+    puede compartir entre threads, por ejemplo en la cache de planes.
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def relabel_aliases(self, change_map):
+        # los valores son independientes de los alias exteriores
+        pass
+
+    def materialize(self, scope):
+        """Crea la tabla temporal para la sentencia "scope"
+
+        Devuelve el nombre de la tabla, o None si no se ha podido crear.
+        La tabla se elimina al terminar la sentencia.
+        """
+        with _names_lock:
+            table = 'tmp_values_%d' % _names.next()
+        scope.created.append(table)
+        stats.incr('temp.tables')
+        cursor = connection.cursor()
+        try:
+            # el volcado es una sentencia aparte, con su propio ambito
+            # (las tablas de sus subconsultas se eliminan al terminar).
+            with stats.timer('temp.materialize'):
+                with Statement():
+                    self.fill(cursor, connection.ops.quote_name(table))
+        except DatabaseError:
+            stats.incr('temp.errors')
+            return None
+        return table
+
+    def as_sql(self, qn=None, connection=connection):
+        scope, table = statement(), None
+        if scope is not None and supported():
+            if self in scope.used:
+                # ya aparece en esta sentencia: no se puede reabrir
+                stats.incr('temp.repeats')
+            else:
+                scope.used.add(self)
+                table = self.materialize(scope)
+        if table is None:
+            # fuera de una ejecucion (solo se compila), o sin tabla
+            return self.fallback()
+        return ('(SELECT v FROM %s)' % connection.ops.quote_name(table), ())
+
+
+def _sliced(queryset):
+    """Indica si la consulta tiene LIMIT u OFFSET"""
+    query = queryset.query
+    return bool(query.low_mark or query.high_mark is not None)
+
+
+class QueryValues(TempValues):
+
+    """Valores de un atributo en el resultado de uno o varios QuerySets
+
+    Con varios QuerySets (del mismo modelo), la tabla temporal contiene
+    la union de todos ellos, sin repeticiones.
+    """
+
+    def __init__(self, attrib, *querysets):
+        self.attrib = attrib
+        self.querysets = querysets
+
+    def _column(self):
+        meta = self.querysets[0].model._meta
+        if self.attrib == 'pk':
+            return meta.pk.column
+        return meta.get_field(self.attrib).column
+
+    def _sql(self, union):
+        sql, params = list(), list()
+        for queryset in self.querysets:
+            part, args = queryset.values(self.attrib).query.as_sql()
+            if len(self.querysets) > 1 and _sliced(queryset):
+                # en una union, los miembros con LIMIT van entre parentesis
+                part = '(%s)' % part
+            sql.append(part)
+            params.extend(args)
+        return (union.join(sql), tuple(params))
+
+    def fill(self, cursor, table):
+        column = connection.ops.quote_name(self._column())
+        sql, params = self._sql(' UNION ALL ')
+        cursor.execute('CREATE TEMPORARY TABLE %s (PRIMARY KEY (v)) '
+                       'SELECT DISTINCT s.%s AS v FROM (%s) AS s '
+                       'WHERE s.%s IS NOT NULL' % (table, column, sql, column),
+                       params)
+
+    def fallback(self):
+        sql, params = self._sql(' UNION ')
+        if any(_sliced(x) for x in self.querysets):
+            # MySQL no admite LIMIT en una subconsulta "IN" (error 1235),
+            # pero si en una tabla derivada.
+            sql = 'SELECT * FROM (%s) AS s' % sql
+        return ('(%s)' % sql, params)
+
+
+class ListValues(TempValues):
+
+    """Lista de valores literales"""
+
+    # longitud maxima de las cadenas que se guardan en la tabla
+    MAXLEN = 255
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def fill(self, cursor, table):
+        values = set(x for x in self.values if x is not None)
+        if all(isinstance(x, (int, long)) for x in values):
+            db_type = 'bigint'
+        else:
+            values = set(unicode(x) for x in values)
+            if any(len(x) > ListValues.MAXLEN for x in values):
+                raise DatabaseError('valor demasiado largo')
+            db_type = 'varchar(%d)' % ListValues.MAXLEN
+        cursor.execute('CREATE TEMPORARY TABLE %s (v %s NOT NULL, '
+                       'PRIMARY KEY (v))' % (table, db_type))
+        values = list((x,) for x in values)
+        sql = 'INSERT IGNORE INTO %s (v) VALUES (%%s)' % table
+        for index in xrange(0, len(values), CHUNK):
+            cursor.executemany(sql, values[index:index+CHUNK])
+        stats.incr('temp.rows', len(values))
+
+    def fallback(self):
+        return ('(%s)' % ', '.join(['%s'] * len(self.values)), self.values)
+
+
+def subquery(queryset, attrib):
+    """Devuelve el valor a usar en un lookup "__in" sobre la subconsulta"""
+    if supported():
+        return QueryValues(attrib, queryset)
+    return queryset.values(attrib)
+
+
+def union(querysets, attrib='pk'):
+    """Devuelve el valor a usar en un lookup "__in" sobre varias subconsultas
+
+    Equivale a "IN (SELECT ... UNION SELECT ...)". En MySQL, la union
+    se vuelca a una tabla temporal (UNION ALL, eliminando luego los
+    duplicados con la clave primaria).
+    """
+    return QueryValues(attrib, *querysets)
+
+
+def literal(values):
+    """Devuelve el valor a usar en un lookup "__in" sobre una lista
+
+    Las listas de al menos THRESHOLD elementos se vuelcan a una tabla
+    temporal, en lugar de incluirse en el SQL.
+    """
+    values = tuple(values)
+    if THRESHOLD is not None and len(values) >= THRESHOLD and supported():
+        return ListValues(values)
+    return values
+
+
+def _membership(child):
+    """Indica si el hijo de un WhereNode es un "IN" sobre TempValues"""
+    if isinstance(child, Node) or len(child) != 4:
+        return False
+    lvalue, lookup_type, annotation, params = child
+    return (isinstance(lvalue, tuple) and lookup_type == 'in' and
+            isinstance(params, TempValues))
+
+
+def _joinable(node):
+    """Recorre las condiciones del nivel superior de un WhereNode
+
+    Devuelve tuplas (nodo, hijo, condicion, negada), solo para las
+    condiciones unidas con AND hasta la raiz.
+    """
+    if node.negated or (node.connector != AND and len(node.children) > 1):
+        return
+    for child in list(node.children):
+        if _membership(child):
+            yield (node, child, child, False)
+        elif isinstance(child, Node):
+            if (child.negated and len(child.children) == 1 and
+                _membership(child.children[0])):
+                yield (node, child, child.children[0], True)
+            else:
+                for item in _joinable(child):
+                    yield item
+
+
+def subqueries(node):
+    """Devuelve los QuerySets de los QueryValues de un WhereNode"""
+    for child in node.children:
+        if isinstance(child, Node):
+            for item in subqueries(child):
+                yield item
+        elif _membership(child) and isinstance(child[3], QueryValues):
+            for item in child[3].querysets:
+                yield item
+
+
+def semijoin(query):
+    """Reescribe como joins las condiciones de pertenencia del nivel superior
+
+    Devuelve la propia consulta si no hay nada que reescribir, o una copia
+    modificada en otro caso. Solo se debe aplicar a la consulta que se va a
+    ejecutar, dentro de su ambito (ver TempQuery): los joins extra no se
+    renombran si la consulta se usa luego como subconsulta.
+    """
+    scope = statement()
+    if scope is None or not any(True for x in _joinable(query.where)):
+        return query
+    query = query.clone()
+    qn = connection.ops.quote_name
+    joins, where = list(), list()
+    for node, child, cond, negated in list(_joinable(query.where)):
+        (alias, column, db_type), values = cond[0], cond[3]
+        if values in scope.used:
+            # una tabla temporal solo puede aparecer en un join
+            continue
+        scope.used.add(values)
+        table = values.materialize(scope)
+        if table is None:
+            # se queda como subconsulta (as_sql usa el fallback)
+            continue
+        node.children.remove(child)
+        name = 'sj%d' % len(joins)
+        outer = '%s.%s' % (qn(alias), qn(column))
+        if not negated:
+            joins.append('INNER JOIN %s %s ON %s.v = %s' %
+                         (qn(table), name, name, outer))
+        else:
+            # NOT (x IN ...) tampoco incluye las filas con x NULL
+            joins.append('LEFT OUTER JOIN %s %s ON %s.v = %s' %
+                         (qn(table), name, name, outer))
+            where.append('%s.v IS NULL AND %s IS NOT NULL' % (name, outer))
+        stats.incr('temp.joins')
+    if joins:
+        query.add_extra(None, None, where, None, None, None, joins)
+    return query
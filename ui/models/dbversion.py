@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+"""
+Canal de versiones compartido entre procesos
+
+Cada worker mantiene sus propias caches (modelos, perfiles...), y necesita
+saber cuando otro proceso ha modificado los datos de los que dependen.
+Este modulo ofrece un canal de versiones barato de consultar, con un
+backend intercambiable:
+
+    - CacheBackend: guarda las versiones en el backend de cache de django.
+    - FileBackend: guarda cada version en un fichero de un directorio local.
+
+El backend se selecciona con el setting VERSION_BACKEND ('cache', 'file' o
+la ruta completa a una clase), y el directorio del FileBackend con el
+setting VERSION_DIR.
+
+Las versiones solo se comparan por igualdad, no por orden.
+"""
+
+import os
+import time
+import tempfile
+from itertools import count
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Clave de la version de esquema (el id del ultimo ChangeLog)
+SCHEMA_KEY = 'schema'
+
+# Clave de la version de los datos de una tabla generada
+DATA_KEY = 'data.%s'
+
+# Clave de la version de las vistas (View, TableView, UserView)
+VIEWS_KEY = 'views'
+
+# Tiempo de vida de las claves en la cache de django (30 dias, el maximo
+# que acepta memcached como tiempo relativo)
+CACHE_TIMEOUT = 30 * 24 * 3600
+
+
+class CacheBackend(object):
+
+    """Versiones almacenadas en el backend de cache de django"""
+
+    def __init__(self, prefix='plantiweb.version.'):
+        self.prefix = prefix
+
+    def get(self, key):
+        return cache.get(self.prefix + key)
+
+    def get_many(self, keys):
+        keys = tuple(keys)
+        found = cache.get_many(tuple(self.prefix + x for x in keys))
+        return dict((x, found.get(self.prefix + x)) for x in keys)
+
+    def set(self, key, value):
+        cache.set(self.prefix + key, value, CACHE_TIMEOUT)
+
+
+class FileBackend(object):
+
+    """Versiones almacenadas en ficheros de un directorio local
+
+    Cada clave se guarda en un fichero independiente. Las escrituras se
+    hacen sobre un fichero temporal que luego se renombra, para que los
+    lectores nunca vean un fichero a medio escribir.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = getattr(settings, 'VERSION_DIR', None)
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'plantiweb')
+        self.path = path
+
+    def _filename(self, key):
+        return os.path.join(self.path, '%s.version' % key)
+
+    def get(self, key):
+        try:
+            stamp = open(self._filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            value = stamp.read().strip()
+        finally:
+            stamp.close()
+        if not value:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+    def get_many(self, keys):
+        return dict((x, self.get(x)) for x in keys)
+
+    def set(self, key, value):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # otro proceso puede haberlo creado a la vez
+                if not os.path.isdir(self.path):
+                    raise
+        fd, tmpname = tempfile.mkstemp(dir=self.path)
+        try:
+            os.write(fd, str(value))
+        finally:
+            os.close(fd)
+        filename = self._filename(key)
+        try:
+            os.rename(tmpname, filename)
+        except OSError:
+            # en windows, rename no sobreescribe el fichero destino
+            os.remove(filename)
+            os.rename(tmpname, filename)
+
+
+BACKENDS = {
+    'cache': CacheBackend,
+    'file': FileBackend,
+}
+
+
+def data_key(pk):
+    """Clave de la version de los datos de la tabla indicada"""
+    return DATA_KEY % pk
+
+
+def get_backend(name=None):
+    """Construye el backend indicado por nombre o ruta a la clase"""
+    if name is None:
+        name = getattr(settings, 'VERSION_BACKEND', 'cache')
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        module, attr = name.rsplit('.', 1)
+        backend = getattr(__import__(module, {}, {}, [attr]), attr)
+    return backend()
+
+
+class Versions(object):
+
+    """Canal de versiones
+
+    Las versiones de los contadores son testigos opacos: cada vez que se
+    incrementa un contador, se le asigna un valor nuevo y unico, de forma
+    que no es necesario que el backend soporte incrementos atomicos.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._tokens = count()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    def _token(self):
+        """Genera un testigo de version unico"""
+        return '%x.%x.%x' % (int(time.time() * 1000), os.getpid(),
+                             self._tokens.next())
+
+    def get(self, key):
+        """Devuelve la version actual del contador indicado
+
+        Si el contador no existe (o ha expirado), se le asigna una
+        version nueva.
+        """
+        value = self.backend.get(key)
+        if value is None:
+            value = self.bump(key)
+        return value
+
+    def get_many(self, keys):
+        """Devuelve un diccionario con las versiones de varios contadores"""
+        values = self.backend.get_many(keys)
+        for key, value in values.iteritems():
+            if value is None:
+                values[key] = self.bump(key)
+        return values
+
+    def bump(self, key):
+        """Asigna una version nueva al contador indicado"""
+        value = self._token()
+        self.backend.set(key, value)
+        return value
+
+    def peek(self, key):
+        """Devuelve el valor almacenado, o None si no existe"""
+        return self.backend.get(key)
+
+    def publish(self, key, value):
+        """Asigna un valor concreto a una clave"""
+        self.backend.set(key, value)
+
+
+versions = Versions()
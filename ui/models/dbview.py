@@ -5,11 +5,13 @@
 
 from gettext import gettext as _
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 
 from .dblog import app_label, ChangeLog
 from .dbfields import *
 from .dbmodel import Table
+from .dbversion import versions, VIEWS_KEY
 
 
 class View(models.Model):
@@ -60,3 +62,12 @@ class UserView(models.Model):
         verbose_name_plural = _('vistas de usuarios')
         app_label = app_label
         unique_together = ('user', 'view')
+
+
+def _bump_views(sender, **kw):
+    """Cambia la version de las vistas cuando se modifica alguna"""
+    if sender in (View, TableView, UserView):
+        versions.bump(VIEWS_KEY)
+
+post_save.connect(_bump_views)
+post_delete.connect(_bump_views)
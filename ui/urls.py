@@ -22,9 +22,11 @@ urlpatterns = urlpatterns + patterns('ui.views',
     # Navegacion
     url(r'^home/$', 'homeview', name='homeview'),
     url(r'^grid/(?P<pk>\d+)/$', 'gridview', name='gridview'),
+    url(r'^grid/(?P<pk>\d+)/json/$', 'gridjson', name='gridjson'),
     url(r'^help/(?P<pk>\d+)/$', 'helpview', name='helpview'),
     url(r'^add/(?P<pk>\d+)/$', 'addview', name='addview'),
     url(r'^goto/(?P<parent_pk>\d+)/(?P<parent_instance>\d+)/(?P<child_pk>\d+)/$', 'gotoview', name='gotoview'),
+    url(r'^stats/$', 'statsview', name='statsview'),
     #url(r'^home/(?P<attr>\w[\w\d]*)/$', 'nodelist', name='rootview'),
     #url(r'^list(?P<path>(/\w[\w\d]*)+)/(?P<id>\d+)/(?P<attr>\w[\w\d]*)/$',
     #       'nodelist', name='listview'),
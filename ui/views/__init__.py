@@ -4,10 +4,11 @@
 
 # los modelos estan definidos en el paquete "tipos"
 from .home import homeview
-from .grid import gridview
+from .grid import gridview, gridjson
 from .help import helpview
 from .add import addview
 from .goto import gotoview
+from .stats import statsview
 #from .node import node
 #from .nodelist import nodelist
 
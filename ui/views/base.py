@@ -8,6 +8,8 @@ from functools import wraps
 from django.forms import ModelForm
 
 from ..models import ChangeLog, Cache, Table, UserView, TableView, View
+from ..models.dbversion import versions, VIEWS_KEY
+from ..models.dbshared import shared
 
 
 DEFAULT_VIEW = 'Default'
@@ -27,8 +29,11 @@ class Profile(object):
             self.view = None
         self.invalidate()
 
-    def invalidate(self):
-        self.version = ChangeLog.objects.current().pk
+    def invalidate(self, version=None):
+        if version is None:
+            version = ChangeLog.objects.version()
+        self.version = version
+        self.views = versions.get(VIEWS_KEY)
         self._identities = dict()
         self._fields = dict()
         self._summaries = dict()
@@ -52,14 +57,26 @@ class Profile(object):
             return d.setdefault(pk, func(model, pk, *args))
 
     def _from_view(self, model, pk, attrib, default):
-        """Obtiene un atributo del objeto TableView"""
-        try:
-            item = TableView.objects.get(view=self.view, table=pk)
-        except (TableView.DoesNotExist):
+        """Obtiene un atributo del objeto TableView
+
+        Las definiciones de las vistas se comparten entre procesos a traves
+        de la cache compartida (ver dbshared).
+        """
+        key = '%s.%s.%s' % (self.views, self.view, pk)
+        item = shared.get('views', key)
+        if item is None:
+            try:
+                item = TableView.objects.get(view=self.view, table=pk)
+            except (TableView.DoesNotExist):
+                item = False
+            else:
+                item = {'summary': item.summary, 'fields': item.fields}
+            shared.set('views', key, item)
+        if not item:
             if default is None:
                 raise KeyError(model._DOMD.fullname)
             return default
-        return getattr(item, attrib)
+        return item[attrib]
 
     def _identity(self, model, pk):
         """Busca la identidad de una tabla"""
@@ -137,9 +154,19 @@ def with_profile(func):
                 userview = None
             profile = Profile(userview)
             request.session['profile'] = profile
-        if profile.version != ChangeLog.objects.current().pk:
-            Cache.invalidate()
-            profile.invalidate()
-        return func(request, *arg, **kw)
+        # la version se consulta en el canal compartido, sin acceder
+        # a la base de datos.
+        version = ChangeLog.objects.version()
+        Cache.update(version)
+        Cache.data.refresh()
+        if (profile.version != version or
+            getattr(profile, 'views', None) != versions.get(VIEWS_KEY)):
+            profile.invalidate(version)
+        # la peticion usa la misma generacion de modelos de principio a fin
+        Cache.pin()
+        try:
+            return func(request, *arg, **kw)
+        finally:
+            Cache.release()
     return view
 
@@ -13,6 +13,7 @@ from django.contrib.auth.decorators import login_required
 
 from .base import with_profile
 from ..models import Cache
+from ..models.dbpath import resolve_paths
 
 
 @login_required
@@ -23,16 +24,15 @@ def gotoview(request, parent_pk, parent_instance, child_pk):
         profile = request.session['profile']
         model = Cache(parent_pk)
         child = Cache(child_pk)
-        instance = model.objects.get(pk=parent_instance)
+        levels = model._DOMD.path
+        identities = tuple(profile.identity(x) for x in levels)
+        # las identidades de todos los ancestros, con una sola consulta
+        values = resolve_paths(model, (int(parent_instance),), identities)
+        values = values[int(parent_instance)]
     except (KeyError, IndexError):
         query = ""
     else:
-        identities = (profile.identity(x) for x in model._DOMD.path)
-        path = []
-        for attr in reversed(tuple(identities)):
-            path.append((instance._DOMD.name, attr, getattr(instance, attr)))
-            instance = instance.up
-        path.reverse()
+        path = zip((x._DOMD.name for x in levels), identities, values)
         query = [];
         for name, identity, value in path:
             if not isinstance(value, numbers.Real):
@@ -3,13 +3,21 @@
 # -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
 
 
+import operator
 from itertools import chain
 from collections import namedtuple
 
+from django.conf import settings
+from django.http import HttpResponse
+from django.db.models import Q
+from django.utils import simplejson
+from django.utils.html import escape
+from django.contrib.markup.templatetags.markup import markdown
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
 
+from ..models.dbshared import shared
 from .base import with_profile
 from .homecontext import HomeContext
 
@@ -53,9 +61,32 @@ class GridRow(tuple):
 @with_profile
 def gridview(request, pk=None):
     hc = HomeContext(request)
-    items = hc.run_query(request, hc['q'], int(pk) if pk is not None else None)
+    try:
+        offset = max(int(request.GET.get('o', 0)), 0)
+    except ValueError:
+        offset = 0
+    limit = getattr(settings, 'GRID_PAGE_SIZE', None)
+    items = hc.count_query(request, hc['q'],
+                           int(pk) if pk is not None else None)
+    if (items is not None and limit and hc['item_count'] > limit and
+        getattr(settings, 'GRID_SERVER_SIDE', False)):
+        # los resultados grandes los pagina dataTables contra gridjson
+        hc['item_serverside'] = True
+        hc['item_pagesize'] = limit
+        hc['item_fixedcount'] = len(hc['item_parents']) + len(hc['item_summary'])
+        hc['item_columns'] = grid_options(hc, True)
+        hc['item_griddata'] = tuple()
+        return render_to_response('datanav/grid.html', hc,
+            context_instance=RequestContext(request))
     # "customizo" los datos para hacer su representacion mas facil.
     if items is not None:
+        hc['item_columns'] = grid_options(hc, False)
+        if limit:
+            # enlaces a las paginas anterior y siguiente
+            hc['item_hasprev'] = offset > 0
+            hc['item_prev'] = max(offset - limit, 0)
+            hc['item_hasnext'] = offset + limit < hc['item_count']
+            hc['item_next'] = offset + limit
         parents = hc['item_parents']
         summary = hc['item_summary']
         hiddens = hc['item_hiddens']
@@ -64,7 +95,142 @@ def gridview(request, pk=None):
         hc['item_fixedcount'] = len(parents) + len(summary)
         attribs = tuple(chain(summary, hiddens))
         domd = hc['model']._DOMD
+        # Si el resultado viene de la cache y no hay campos calculados
+        # (ni en las columnas, ni en las identidades de los ancestros), el
+        # html solo depende de los datos y de la vista del usuario.
+        identities = zip(domd.parents, hc['item_identities'])
+        fragment = None
+        if (hc['item_versions'] is not None and
+            not domd.dynamics.intersection(attribs) and
+            not any(x in p._DOMD.dynamics for p, x in identities)):
+            profile = request.session['profile']
+            fragment = repr((profile.views, profile.view, pk, hc['q'],
+                             offset, limit,
+                             sorted(hc['item_versions'].iteritems())))
+            content = shared.get('grid', fragment)
+            if content is not None:
+                return HttpResponse(content)
+        items = hc.load_page(items, offset, limit)
+        # calculo las columnas dinamicas con las subtablas precargadas
+        domd.objects.prefetch(tuple(x[1] for x in items), attribs)
         items = tuple(GridRow(x, attribs, domd) for x in items)
         hc['item_griddata'] = items
+        if fragment is not None:
+            response = render_to_response('datanav/grid.html', hc,
+                context_instance=RequestContext(request))
+            shared.set('grid', fragment, response.content)
+            return response
     return render_to_response('datanav/grid.html', hc,
         context_instance=RequestContext(request))
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _column(domd, attrib, prefix=None):
+    """Nombre del campo en SQL, o None si es calculado"""
+    if attrib is None:
+        return None
+    if attrib in domd.dynamics:
+        # solo los materializados tienen columna
+        attrib = domd.columns.get(attrib)
+        if attrib is None:
+            return None
+    return '%s__%s' % (prefix, attrib) if prefix else attrib
+
+
+def grid_columns(hc):
+    """Campos SQL por los que se puede ordenar o buscar cada columna del grid
+
+    Las columnas son las de GridRow, precedidas de la del checkbox. Las que
+    no se pueden resolver en SQL (el checkbox y los campos calculados no
+    materializados) quedan a None.
+    """
+    domd = hc['model']._DOMD
+    identities = hc['item_identities']
+    columns = [None]
+    for index, (parent, ident) in enumerate(zip(domd.parents, identities)):
+        # las identidades de los ancestros se alcanzan con _up__..._up
+        prefix = '__'.join(('_up',) * (len(identities) - index))
+        columns.append(_column(parent._DOMD, ident, prefix))
+    for attrib in chain(hc['item_summary'], hc['item_hiddens']):
+        columns.append(_column(domd, attrib))
+    return columns
+
+
+def grid_options(hc, serverside):
+    """Opciones (visible, ordenable) de cada columna del grid
+
+    No incluye la columna del checkbox. En modo "server side", la
+    ordenacion se hace en SQL, asi que no se pueden ordenar las columnas
+    sin campo SQL (ver grid_columns).
+    """
+    visible = len(hc['item_parents']) + len(hc['item_summary'])
+    return tuple((index < visible, not serverside or column is not None)
+                 for index, column in enumerate(grid_columns(hc)[1:]))
+
+
+@login_required
+@with_profile
+def gridjson(request, pk=None):
+    """Datos del grid para dataTables, en modo "server side"
+
+    Implementa el protocolo de dataTables 1.5: recibe sEcho,
+    iDisplayStart, iDisplayLength, sSearch, iSortingCols, iSortCol_N y
+    sSortDir_N, y devuelve sEcho, iTotalRecords, iTotalDisplayRecords y
+    aaData. La paginacion, la ordenacion y la busqueda se hacen en SQL.
+    Agrega ademas oAnnotations, con las anotaciones de las filas.
+    """
+    params = request.GET
+    hc = HomeContext(request)
+    start = max(_int(params.get('iDisplayStart'), 0), 0)
+    length = _int(params.get('iDisplayLength'), None)
+    if length is None or length < 0:
+        length = getattr(settings, 'GRID_PAGE_SIZE', None)
+
+    def refine(hc, items):
+        columns = grid_columns(hc)
+        search = params.get('sSearch', '').strip()
+        if search:
+            crit = (Q(**{'%s__icontains' % x: search}) for x in columns if x)
+            items = items.filter(reduce(operator.or_, crit, Q(pk__isnull=True)))
+        order = list()
+        for index in xrange(_int(params.get('iSortingCols'), 0)):
+            column = _int(params.get('iSortCol_%d' % index), -1)
+            if 0 <= column < len(columns) and columns[column]:
+                desc = params.get('sSortDir_%d' % index) == 'desc'
+                order.append('%s%s' % ('-' if desc else '', columns[column]))
+        if order:
+            items = items.order_by(*order)
+        return items
+
+    items = hc.run_query(request, hc['q'], int(pk) if pk is not None else None,
+                         start, length, refine)
+    data = {
+        'sEcho': _int(params.get('sEcho'), 0),
+        'iTotalRecords': 0,
+        'iTotalDisplayRecords': 0,
+        'aaData': list(),
+        'oAnnotations': dict(),
+    }
+    if items is not None:
+        attribs = tuple(chain(hc['item_summary'], hc['item_hiddens']))
+        domd = hc['model']._DOMD
+        domd.objects.prefetch(tuple(x[1] for x in items), attribs)
+        for row in (GridRow(x, attribs, domd) for x in items):
+            cells = ['<input type="checkbox" value="%d"/>' % row.pk]
+            for cell in row:
+                value = escape(cell.value)
+                if cell.css:
+                    value = '<span class="%s">%s</span>' % (cell.css, value)
+                cells.append(value)
+            data['aaData'].append(cells)
+            if row.annotations:
+                data['oAnnotations'][row.pk] = markdown(row.annotations)
+        data['iTotalRecords'] = hc['item_total']
+        data['iTotalDisplayRecords'] = hc['item_count']
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
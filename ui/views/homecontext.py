@@ -7,6 +7,8 @@ from gettext import gettext as _
 from collections import namedtuple
 
 from ..models import Field, Link, Table, Cache
+from ..models.dbresults import results
+from ..models.dbpath import resolve_paths
 
 
 DEFAULT_HIST_LEN = 10
@@ -135,12 +137,16 @@ class HomeContext(dict):
 
         """Objeto precedido de ruta"""
 
-        def __new__(cls, model, identities, instance):
+        def __new__(cls, model, identities, instance, path=None):
             """
             model: modelo del objeto
             identities: campos a recuperar de los modelos ancestros
             instance: instancia
+            path: identidades ya resueltas (ver dbpath.resolve_paths)
             """
+            if path is not None:
+                return super(HomeContext.PathItem, cls).__new__(cls,
+                           list(path), instance)
             obj = super(HomeContext.PathItem, cls).__new__(cls, [], instance)
             for attr in reversed(identities):
                 instance = instance.up
@@ -152,7 +158,7 @@ class HomeContext(dict):
         """Analiza la query y obtiene la lista de tablas que participan"""
         # Cargo los datos
         try:
-            items = Cache.evaluate(q)
+            items = results.query(q)
         except Exception, e:
             # TODO: volcar adecuadamente los datos de la excepcion
             print "EXCEPCION! %s, query: %s" % (str(e), q)
@@ -168,18 +174,40 @@ class HomeContext(dict):
             self['toplevels'] = Cache.root._DOMD.children.all().keys()
         return items
 
-    def run_query(self, request, q, pk=None):
+    def run_query(self, request, q, pk=None, offset=0, limit=None, refine=None):
         """Ejecuta la query y devuelve la lista de objetos
 
         "q" indica la consulta completa a ejecutar. Sin embargo, lo
         que se devuelve no es necesariamente el resultado de la query.
         Si pk != None, se va subiendo en la query (usando .up) hasta
         llegar a una tabla cuya pk sea la indicada.
+
+        Si se indica "limit", solo se devuelven (y se leen de la base
+        de datos) "limit" objetos a partir de "offset". El numero total
+        de objetos queda en self['item_count'].
+
+        "refine" es una funcion opcional que recibe este contexto y el
+        QuerySet, y devuelve otro (filtrado, ordenado...) antes de contar
+        y paginar. En ese caso, el total sin refinar queda en
+        self['item_total'].
+        """
+        items = self.count_query(request, q, pk, refine)
+        if items is None:
+            return
+        return self.load_page(items, offset, limit)
+
+    def count_query(self, request, q, pk=None, refine=None):
+        """Prepara el contexto y cuenta los objetos, sin leerlos
+
+        Los parametros son los de run_query. Devuelve el QuerySet (o la
+        lista) completo, para pasarlo luego a load_page.
         """
         items = self.analyze_query(request, q)
         if items is None:
             return
         full_path = self['item_full_path']
+        # versiones de los datos del resultado, si viene de dbresults
+        self['item_versions'] = getattr(items, '_versions', None)
         model = items._type
         profile = request.session['profile']
         if pk in set(x._DOMD.pk for x in model._DOMD.parents):
@@ -203,7 +231,35 @@ class HomeContext(dict):
         self['item_summary'] = summary
         self['item_hiddens'] = tuple(x for x in fields if x not in visible)
         self['item_identity'] = profile.identity(model)
-        self['items'] = tuple(HomeContext.PathItem(model, identities, x)
+        self['item_identities'] = identities
+        # el total y la pagina se calculan en SQL (COUNT, LIMIT / OFFSET)
+        if hasattr(items, 'query'):
+            self['item_count'] = items.count()
+            if refine is not None:
+                self['item_total'] = self['item_count']
+                items = refine(self, items)
+                self['item_count'] = items.count()
+        else:
+            items = tuple(items)
+            self['item_count'] = len(items)
+        self.setdefault('item_total', self['item_count'])
+        self['item_offset'] = 0
+        return items
+
+    def load_page(self, items, offset=0, limit=None):
+        """Lee los objetos de la pagina indicada (ver count_query)"""
+        model, identities = self['model'], self['item_identities']
+        self['item_offset'] = offset
+        if limit is not None:
+            items = items[offset:offset+limit]
+        elif offset:
+            items = items[offset:]
+        # las identidades de los ancestros de toda la pagina, con
+        # una sola consulta
+        items = tuple(items)
+        paths = resolve_paths(model, tuple(x.pk for x in items), identities)
+        self['items'] = tuple(HomeContext.PathItem(model, identities, x,
+                                                   paths.get(x.pk))
                               for x in items)
         return self['items']
 
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+
+from django.http import HttpResponse
+from django.utils import simplejson
+from django.contrib.auth.decorators import login_required, user_passes_test
+
+from ..models import Cache
+
+
+@login_required
+@user_passes_test(lambda user: user.is_staff)
+def statsview(request):
+    """Estadisticas internas de la cache de modelos, en JSON"""
+    data = simplejson.dumps(Cache.stats(), indent=2)
+    return HttpResponse(data, mimetype='application/json')